@@ -0,0 +1,80 @@
+# Copyright (c) 2015 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+import os
+import sys
+import time
+import argparse
+
+from abcd import ABCParser
+
+def parse_new(data, count):
+    # A new parser for every parse.
+    for i in xrange(count):
+        parser = ABCParser.ABCParser(data)
+        parser.parse()
+        parser.resolve_multinames()
+
+def parse_reset(data, count):
+    # One parser, reset() before every parse.
+    parser = ABCParser.ABCParser(data)
+    for i in xrange(count):
+        parser.reset(data)
+        parser.parse()
+        parser.resolve_multinames()
+
+def best_of(func, data, count, runs):
+    best = None
+    for i in xrange(runs):
+        start = time.time()
+        func(data, count)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def __main__():
+    parser = argparse.ArgumentParser(description='Time parsing raw ABC files '
+                                                 'with new parsers and with '
+                                                 'reset().')
+    parser.add_argument('-n', '--count', type=int, default=100,
+                        help='parses per run')
+    parser.add_argument('-r', '--runs', type=int, default=5,
+                        help='runs, the best one is reported')
+    parser.add_argument('files', metavar='file', nargs='+',
+                        help='raw ABC file to parse')
+    args = parser.parse_args()
+
+    for file_ in args.files:
+        f = open(file_, 'rb')
+        data = f.read()
+        f.close()
+        for (name, func) in (('new', parse_new), ('reset', parse_reset)):
+            elapsed = best_of(func, data, args.count, args.runs)
+            print "%s %s x%d: %.3fs" % (name,
+                                        os.path.basename(file_),
+                                        args.count,
+                                        elapsed)
+
+if __name__ == '__main__':
+    __main__()
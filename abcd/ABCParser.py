@@ -21,35 +21,17 @@
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
 
-from common import ABCdCommon
-from internals import *
-
-class ABCdException(Exception):
-    def __init__(self):
-        pass
-
-class ABCdBadValue(ABCdException):
-    def __init__(self, msg, val):
-        self.msg = msg
-        self.val = val
-
-    def __str__(self):
-        return "%s: 0x%x" % (self.msg, self.val)
-
-class ABCdBadOpcode(ABCdException):
-    def __init__(self, val):
-        self.val = val
-
-    def __str__(self):
-        return "Invalid opcode: 0x%x" % self.val
-
-class ABCdParseError(ABCdException):
-    def __init__(self, message, offset):
-        self.message = message
-        self.offset = offset
+import sys
+import mmap
+import time
+import hashlib
+import cPickle
+import cStringIO
+from array import array
 
-    def __str__(self):
-        return "(%s) %s" % (self.message, self.offset)
+from common import ABCdCommon, Cursor, StreamData, Limits, numpy
+from common import ABCdException, ABCdBadValue, ABCdBadOpcode, ABCdParseError
+from internals import *
 
 class ABCParser(ABCdCommon):
     CONST_INT = 0x03
@@ -114,31 +96,182 @@ class ABCParser(ABCdCommon):
     FUNC_TRAIT = 0x05
     METH_GET_SET_TRAIT = [ 0x01, 0x02, 0x03 ]
 
+    # Profiles for parse(), mapping to the last section to parse.
+    PROFILES = { 'pool': 'constant_pool',
+                 'layout': 'scripts',
+                 'full': 'method_bodies' }
+
     ATTR_FINAL = 0x01
     ATTR_OVERRIDE = 0x02
     ATTR_METADATA = 0x04
 
+    # Kinds of entries cross referenced by xrefs(), with the property
+    # holding them.
+    XREF_KINDS = {'string': 'strings',
+                  'int': 'ints',
+                  'uint': 'uints',
+                  'double': 'doubles',
+                  'namespace': 'namespaces',
+                  'multiname': 'multinames',
+                  'method': 'methods'}
+
+    # Bump whenever the parsed state changes shape, cached entries stamped
+    # with another version are ignored.
+    CACHE_VERSION = 1
+    # Parser state saved to the cache. Everything else refers to the data
+    # itself and is set up by __init__().
+    _CACHED = ('p', '_sections', '_minor', '_major', '_ints', '_uints',
+               '_doubles', '_strings', '_namespaces', '_namespacesets',
+               '_multinames', '_methods', '_metadata', '_instances',
+               '_classes', '_scripts', '_method_bodies', '_interned')
+
     from operator import attrgetter
 
-    def __init__(self, data):
-        self._data = data
+    def __init__(self,
+                 data,
+                 lazy=False,
+                 lazy_bodies=False,
+                 window_size=1 << 20,
+                 cache=None,
+                 observer=None,
+                 limits=None,
+                 code_cache=None):
+        # data can be anything supporting the buffer interface (str,
+        # bytearray, memoryview, mmap). It is never copied, method body code
+        # is a view into it.
+        #
+        # If lazy is True parse() only does a quick pass over the data,
+        # recording where every entry starts. Entries are parsed the first
+        # time they are accessed.
+        #
+        # If lazy_bodies is True (implied by lazy) method bodies only have
+        # their header parsed. Code, exceptions and traits are parsed the
+        # first time they are accessed.
+        #
+        # data can also be a file-like object, starting at its current
+        # position. It is then read through a sliding window of window_size
+        # bytes instead of being held in memory. Method bodies are always
+        # lazy in that case, code is read from the file each time it is
+        # accessed.
+        #
+        # cache is an ABCCache. parse() loads from it when it has an entry
+        # for the same data, options and profile and stores to it otherwise.
+        #
+        # observer is a ParseObserver, told when parse() starts and ends
+        # each section.
+        #
+        # limits is a Limits, capping the work done for hostile data. Counts
+        # which can not fit in the data are always rejected.
+        #
+        # code_cache is a CodeCache, usually shared by all parsers of a
+        # process. Method bodies look their decoded instructions up in it by
+        # code digest before decoding.
         self.p = 0
+        self._lazy = lazy
+        self._lazy_bodies_option = lazy or lazy_bodies
+        self._window_size = window_size
+        self._stream = None
+        self._set_data(data)
+        self._cache = cache
+        self._observer = observer
+        self._code_cache = code_cache
+        self._limits = limits or Limits()
+        self._max_entries = self._limits.max_entries
+        self._deadline = None
+        self._sections = {}
 
         self._minor = 0
         self._major = 0
-        self._ints = [0]
-        self._uints = [0]
-        self._doubles = [float('nan')]
+        # Numeric constants are stored in arrays instead of lists of boxed
+        # numbers. Values are at most 32 bits.
+        self._ints = array('i', [0])
+        self._uints = array('I', [0])
+        self._doubles = array('d', [float('nan')])
         self._strings = [""]
-        self._namespaces = [Namespace(0, 0)]
-        self._namespacesets = [[]]
-        self._multinames = [[]]
+        self._namespaces = NamespaceTable()
+        self._namespacesets = [()]
+        self._multinames = MultinameTable()
         self._methods = []
         self._metadata = []
         self._instances = []
         self._classes = []
         self._scripts = []
         self._method_bodies = []
+        # Repeated namespace sets and trait metadata lists share one tuple.
+        self._interned = {}
+        # Caches for resolve_multiname() and resolve_trait().
+        self._resolved = None
+        self._resolved_traits = {}
+        # Reverse indexes, built the first time they are used.
+        self._body_index = None
+        self._class_name_index = {}
+        self._class_names_scanned = 0
+        self._class_script_index = None
+        self._method_trait_index = None
+        self._xrefs = None
+        self._xref_errors = {}
+
+    def _set_data(self, data):
+        if self._stream is not None:
+            self._stream.unbind(self)
+        # mmap has read() too, but it is used through the buffer interface
+        # like any other data held in memory.
+        if hasattr(data, 'read') and not isinstance(data, mmap.mmap):
+            self._stream = StreamData(data, self._window_size)
+            self._stream.bind(self)
+            self._data = self._stream
+        else:
+            self._stream = None
+            self._data = data
+        # Code is not kept in memory when reading from a file.
+        self._lazy_bodies = (self._lazy_bodies_option or
+                             self._stream is not None)
+
+    def reset(self, data):
+        """Start over on new ABC data, keeping the options given before.
+
+        Pools and lists are emptied in place and reused, which saves
+        allocating them again in loops over many files. Anything obtained
+        from this parser before, its lists included, must not be used once
+        it is reset.
+        """
+        self._set_data(data)
+        self.p = 0
+        self._deadline = None
+        self._sections.clear()
+        self._minor = 0
+        self._major = 0
+        del self._ints[1:]
+        del self._uints[1:]
+        del self._doubles[1:]
+        self._strings = [""]
+        self._namespaces.clear()
+        self._namespacesets = self._emptied(self._namespacesets, [()])
+        self._multinames.clear()
+        self._methods = self._emptied(self._methods, [])
+        self._metadata = self._emptied(self._metadata, [])
+        self._instances = self._emptied(self._instances, [])
+        self._classes = self._emptied(self._classes, [])
+        self._scripts = self._emptied(self._scripts, [])
+        self._method_bodies = self._emptied(self._method_bodies, [])
+        self._interned.clear()
+        self._resolved = None
+        self._resolved_traits.clear()
+        self._body_index = None
+        self._class_name_index.clear()
+        self._class_names_scanned = 0
+        self._class_script_index = None
+        self._method_trait_index = None
+        self._xrefs = None
+        self._xref_errors = {}
+
+    def _emptied(self, container, fresh):
+        # Lists are reused, anything else (LazyList in lazy mode) is
+        # replaced by fresh.
+        if type(container) is not list:
+            return fresh
+        del container[len(fresh):]
+        return container
 
     @property
     def minor(self):
@@ -150,6 +283,16 @@ class ABCParser(ABCdCommon):
         """Major version parsed from ABC data."""
         return self._major
 
+    @property
+    def code_cache(self):
+        """CodeCache shared with other parsers, or None."""
+        return self._code_cache
+
+    @property
+    def sections(self):
+        """Dictionary of section name to byte offset in ABC data."""
+        return self._sections
+
     @property
     def ints(self):
         """Integer constants parsed from ABC data."""
@@ -215,92 +358,379 @@ class ABCParser(ABCdCommon):
         """Method bodies parsed from ABC data."""
         return self._method_bodies
 
-    def parse(self):
+    def parse(self, profile='full'):
+        # The profile decides how far to parse. 'pool' stops after the
+        # constant pool, 'layout' stops before the method bodies.
+        if profile not in self.PROFILES:
+            raise ValueError("Unknown parse profile: %s" % profile)
+        last = self.PROFILES[profile]
+
+        if self._limits.max_seconds is not None:
+            self._deadline = time.time() + self._limits.max_seconds
+        try:
+            self._parse(profile, last)
+        finally:
+            self._deadline = None
+
+    def _parse(self, profile, last):
+        if self._cache is not None:
+            self._section_start('cache')
+            key = self._cache_key(profile)
+            hit = self._load_cached(key)
+            self._section_end('cache')
+            if hit:
+                return
+
         self._minor = self._readU16()
         self._major = self._readU16()
 
-        self._parse_constant_pool()
-        self._parse_method()
-        self._parse_metadata()
-        self._parse_classes()
-        self._parse_scripts()
-        self._parse_method_bodies()
+        if self._lazy:
+            sections = [('constant_pool', self._index_constant_pool),
+                        ('methods', self._index_method),
+                        ('metadata', self._index_metadata),
+                        ('classes', self._index_classes),
+                        ('scripts', self._index_scripts),
+                        ('method_bodies', self._index_method_bodies)]
+        else:
+            sections = [('constant_pool', self._parse_constant_pool),
+                        ('methods', self._parse_method),
+                        ('metadata', self._parse_metadata),
+                        ('classes', self._parse_classes),
+                        ('scripts', self._parse_scripts),
+                        ('method_bodies', self._parse_method_bodies)]
+        for (name, func) in sections:
+            self._sections[name] = self.p
+            self._section_start(name)
+            func()
+            self._section_end(name)
+            if name == last:
+                break
+
+        if self._cache is not None:
+            self._store_cached(key)
 
-    def _parse_constant_pool(self):
-        for i in xrange(1, self._readU30()):
-            self._ints.append(self._readS32())
+    def _checkCount(self, count, size, offset):
+        # Every entry list starts with a count, which makes this a good
+        # place to keep an eye on the clock too.
+        if self._deadline is not None and time.time() > self._deadline:
+            raise ABCdParseError("Parse exceeded max_seconds", offset)
+        ABCdCommon._checkCount(self, count, size, offset)
+
+    def _section_start(self, name):
+        if self._observer is not None:
+            self._observer.section_start(self, name)
+
+    def _section_end(self, name):
+        if self._observer is not None:
+            self._observer.section_end(self, name)
+
+    def _cache_key(self, profile):
+        digest = hashlib.sha256()
+        if self._stream is not None:
+            size = self._stream._window_size
+            for offset in xrange(0, len(self._stream), size):
+                digest.update(self._stream.read(offset, size))
+        else:
+            digest.update(self._data)
+        return '%s-%s-%d%d' % (digest.hexdigest(),
+                               profile,
+                               self._lazy,
+                               self._lazy_bodies)
+
+    def _store_cached(self, key):
+        # Entries refer back to the parser, it is saved by reference only
+        # and replaced with whichever parser loads the entry.
+        out = cStringIO.StringIO()
+        pickler = cPickle.Pickler(out, cPickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = lambda obj: 'parser' if obj is self else None
+        pickler.dump(dict((name, getattr(self, name))
+                          for name in self._CACHED))
+        self._cache.put(key, self.CACHE_VERSION, out.getvalue())
 
-        for i in xrange(1, self._readU30()):
-            self._uints.append(self._readU32())
+    def _load_cached(self, key):
+        payload = self._cache.get(key, self.CACHE_VERSION)
+        if payload is None:
+            return False
+        unpickler = cPickle.Unpickler(cStringIO.StringIO(payload))
+        unpickler.persistent_load = lambda pid: self
+        try:
+            state = unpickler.load()
+        except Exception:
+            # A damaged entry is a miss, it is overwritten after parsing.
+            return False
+        self.__dict__.update(state)
+        return True
 
-        for i in xrange(1, self._readU30()):
-            self._doubles.append(self._readD64())
+    def iter_strings(self, raw=False):
+        """Generator yielding the string pool, reading nothing past it.
 
-        for i in xrange(1, self._readU30()):
-            self._strings.append(self._readString())
+        Does not need parse(). Strings are yielded as they are read, in pool
+        order starting with index 1, undecoded if raw is True.
+        """
+        cursor = Cursor(self._data, 4)
+        cursor._max_entries = self._max_entries
+        if self._stream is not None:
+            self._stream.bind(cursor)
+        # Skip ints, uints and doubles.
+        cursor._skipU30(cursor._readPoolCount())
+        cursor._skipU30(cursor._readPoolCount())
+        count = cursor._readPoolCount(8)
+        cursor.p += count * 8
+        for i in xrange(0, cursor._readPoolCount()):
+            if raw:
+                length = cursor._readU30()
+                yield cursor._readRaw(length)
+            else:
+                yield cursor._readString()
+
+    def _parse_constant_pool(self):
+        self._parse_numbers()
+
+        self._strings = self._index_strings()
 
-        for i in xrange(1, self._readU30()):
-            self._namespaces.append(self._readNamespace())
+        self._parse_namespaces()
 
-        for i in xrange(1, self._readU30()):
+        for i in xrange(0, self._readPoolCount()):
             self._namespacesets.append(self._readNamespaceSet())
 
-        for i in xrange(1, self._readU30()):
-            self._multinames.append(self._readMultiname())
+        self._parse_multinames()
+
+    def _parse_numbers(self):
+        # Shared by both modes, skipping these costs as much as reading them.
+        count = self._readPoolCount()
+        run = self._decodeU32Run(count)
+        if run is not None:
+            (values, lengths, size) = run
+            values = (values & 0xFFFFFFFF).astype(numpy.uint32)
+            self._ints.fromstring(values.view(numpy.int32).tostring())
+            self.p += size
+        else:
+            for i in xrange(0, count):
+                self._ints.append(self._readS32())
+
+        count = self._readPoolCount()
+        run = self._decodeU32Run(count)
+        if run is not None:
+            (values, lengths, size) = run
+            values = (values & 0xFFFFFFFF).astype(numpy.uint32)
+            self._uints.fromstring(values.tostring())
+            self.p += size
+        else:
+            for i in xrange(0, count):
+                self._uints.append(self._readU32() & 0xFFFFFFFF)
+
+        # Doubles are fixed size so the whole run is read in one go.
+        count = self._readPoolCount(8)
+        doubles = array('d')
+        doubles.fromstring(self._readRaw(count * 8))
+        if sys.byteorder == 'big':
+            doubles.byteswap()
+        self._doubles.extend(doubles)
+
+    # Namespaces and multinames go straight into their tables, which does not
+    # create any objects, so these are also shared by both modes.
+    def _parse_namespaces(self):
+        namespaces = self._namespaces
+        count = self._readPoolCount(2)
+        # Each namespace is a kind byte followed by a U30. Valid kinds are
+        # below 0x80 so they decode as single byte values, interleaved with
+        # the names.
+        run = self._decodeU32Run(count * 2)
+        if run is not None and (run[1][0::2] == 1).all():
+            (values, lengths, size) = run
+            namespaces.kind.fromstring(
+                values[0::2].astype(numpy.uint8).tostring())
+            namespaces.name.fromstring(
+                (values[1::2] & 0x3FFFFFFF).astype(numpy.int32).tostring())
+            self.p += size
+            return
+        for i in xrange(0, count):
+            kind = self._readU8()
+            namespaces.append(kind, self._readU30())
+
+    def _parse_multinames(self):
+        multinames = self._multinames
+        for i in xrange(0, self._readPoolCount()):
+            kind = self._readU8()
+            if kind not in self.MULTINAME_KIND:
+                raise ABCdBadValue("Unknown multiname", kind)
+            if kind in self.QNAME:
+                ns = self._readU30()
+                multinames.append(kind, ns=ns, name=self._readU30())
+            elif kind in self.RTQNAME:
+                multinames.append(kind, name=self._readU30())
+            elif kind in self.RTQNAMEL:
+                multinames.append(kind)
+            elif kind in self.MULTINAME:
+                name = self._readU30()
+                ns_set = self._readU30()
+                if ns_set == 0:
+                    raise ABCdBadValue("Invalid ns_set", ns_set)
+                multinames.append(kind, name=name, ns_set=ns_set)
+            elif kind in self.MULTINAMEL:
+                ns_set = self._readU30()
+                if ns_set == 0:
+                    raise ABCdBadValue("Invalid ns_set", ns_set)
+                multinames.append(kind, ns_set=ns_set)
+            elif kind in self.TYPENAME: # Undocumented TypeName
+                name = self._readU30()
+                params = self._readU30Array(self._readCount())
+                multinames.append(kind, name=name, params=params)
 
     def _parse_method(self):
-        for i in xrange(0, self._readU30()):
+        for i in xrange(0, self._readCount(4)):
             self._methods.append(self._readMethod())
 
     def _parse_metadata(self):
-        for i in xrange(0, self._readU30()):
+        for i in xrange(0, self._readCount(2)):
             self.metadata.append(self._readMetadata())
 
     def _parse_classes(self):
         # This one is slightly different, it parses both instance_info and
         # class_info structures.
-        count = self._readU30()
+        count = self._readCount(8)
         for i in xrange(0, count):
             self._instances.append(self._readInstance())
         for i in xrange(0, count):
             self._classes.append(self._readClass())
 
     def _parse_scripts(self):
-        for i in xrange(0, self._readU30()):
-            init = self._readU30()
-            trait_count = self._readU30()
-            traits = []
-            for x in xrange(0, trait_count):
-                traits.append(self._readTrait())
-            self._scripts.append(Script(init, traits))
+        for i in xrange(0, self._readCount(2)):
+            self._scripts.append(self._readScript())
 
     def _parse_method_bodies(self):
-        for i in xrange(0, self._readU30()):
-            method = self._readU30()
-            max_stack = self._readU30()
-            local_count = self._readU30()
-            init_scope_depth = self._readU30()
-            max_scope_depth = self._readU30()
-            code_length = self._readU30()
-            code = self._data[self.p:self.p + code_length]
+        for i in xrange(0, self._readCount(8)):
+            self._method_bodies.append(self._readMethodBody())
+
+    # The _index_* functions are the lazy equivalent of the _parse_*
+    # functions. They skip over each entry, recording where it starts, and
+    # replace the list with a LazyList which parses entries on access.
+    def _index(self, count, skip, reader, head=()):
+        offsets = array('L')
+        for i in xrange(0, count):
+            offsets.append(self.p)
+            skip()
+        return LazyList(self, offsets, reader, head)
+
+    def _index_pool(self, skip, reader, head):
+        return self._index(self._readPoolCount(), skip, reader, head)
+
+    def _index_constant_pool(self):
+        self._parse_numbers()
+        self._strings = self._index_strings()
+        self._parse_namespaces()
+        self._namespacesets = self._index_pool(self._skipNamespaceSet,
+                                               self._readNamespaceSet,
+                                               self._namespacesets)
+        self._parse_multinames()
+
+    def _index_strings(self):
+        # Strings are only decoded when they are accessed, in both modes.
+        # Most of them never are.
+        offsets = array('L')
+        lengths = array('L')
+        for i in xrange(0, self._readPoolCount()):
+            length = self._readU30()
+            offsets.append(self.p)
+            lengths.append(length)
+            self.p += length
+        if self.p > len(self._data):
+            raise ABCdParseError("String pool truncated", self.p)
+        return StringPool(self, offsets, lengths, self._strings)
+
+    def _index_method(self):
+        self._methods = self._index(self._readCount(4),
+                                    self._skipMethod,
+                                    self._readMethod)
+
+    def _index_metadata(self):
+        self._metadata = self._index(self._readCount(2),
+                                     self._skipMetadata,
+                                     self._readMetadata)
+
+    def _index_classes(self):
+        count = self._readCount(8)
+        self._instances = self._index(count,
+                                      self._skipInstance,
+                                      self._readInstance)
+        self._classes = self._index(count, self._skipClass, self._readClass)
+
+    def _index_scripts(self):
+        self._scripts = self._index(self._readCount(2),
+                                    self._skipScript,
+                                    self._readScript)
+
+    def _index_method_bodies(self):
+        self._method_bodies = self._index(self._readCount(8),
+                                          self._skipMethodBody,
+                                          self._readMethodBody)
+
+    def _read_at(self, offset, reader, *args):
+        # Run reader at offset without disturbing the current position.
+        saved = self.p
+        self.p = offset
+        try:
+            return reader(*args)
+        finally:
+            self.p = saved
+
+    def _readScript(self):
+        init = self._readU30()
+        trait_count = self._readCount(4)
+        traits = []
+        for x in xrange(0, trait_count):
+            traits.append(self._readTrait())
+        return Script(init, traits)
+
+    def _readMethodBody(self):
+        method = self._readU30()
+        max_stack = self._readU30()
+        local_count = self._readU30()
+        init_scope_depth = self._readU30()
+        max_scope_depth = self._readU30()
+        code_length = self._readLength()
+        if self._lazy_bodies:
+            offset = self.p
             self.p += code_length
-            exception_count = self._readU30()
-            exceptions = []
-            for x in xrange(0, exception_count):
-                exceptions.append(self._readException())
-            trait_count = self._readU30()
-            traits = []
-            for y in xrange(0, trait_count):
-                traits.append(self._readTrait())
-            self._method_bodies.append(MethodBody(method,
-                                                 max_stack,
-                                                 local_count,
-                                                 init_scope_depth,
-                                                 max_scope_depth,
-                                                 code,
-                                                 exceptions,
-                                                 traits,
-                                                 parser=self))
+            self._skipU30(self._readCount(5) * 5)
+            self._skipTraits()
+            return MethodBody(method,
+                              max_stack,
+                              local_count,
+                              init_scope_depth,
+                              max_scope_depth,
+                              None,
+                              None,
+                              None,
+                              parser=self,
+                              offset=offset,
+                              code_length=code_length)
+        offset = self.p
+        code = self._readBytes(code_length)
+        (exceptions, traits) = self._readMethodBodyTail()
+        return MethodBody(method,
+                          max_stack,
+                          local_count,
+                          init_scope_depth,
+                          max_scope_depth,
+                          code,
+                          exceptions,
+                          traits,
+                          parser=self,
+                          offset=offset,
+                          code_length=code_length)
+
+    def _readMethodBodyTail(self):
+        # Exceptions and traits which follow the code of a method body.
+        exception_count = self._readCount(5)
+        exceptions = []
+        for x in xrange(0, exception_count):
+            exceptions.append(self._readException())
+        trait_count = self._readCount(4)
+        traits = []
+        for y in xrange(0, trait_count):
+            traits.append(self._readTrait())
+        return (exceptions, traits)
 
     def _readException(self):
         from_ = self._readU30()
@@ -310,60 +740,32 @@ class ABCParser(ABCdCommon):
         var_name = self._readU30()
         return ASException(from_, to, target, exc_type, var_name, parser=self)
 
-    def _readNamespace(self):
-        return Namespace(self._readU8(), self._readU30())
-
     def _readNamespaceSet(self):
-        result = []
-        for i in xrange(0, self._readU30()):
-            entry = self._readU30()
-            if entry == 0:
-                raise ABCdBadValue("Entry must not be zero", entry)
-            result.append(entry)
-        return result
+        result = self._readU30Array(self._readCount())
+        if 0 in result:
+            raise ABCdBadValue("Entry must not be zero", 0)
+        return self._intern(result)
 
-    def _readMultiname(self):
-        kind = self._readU8()
-        if kind not in self.MULTINAME_KIND:
-            raise ABCdBadValue("Unknown multiname", kind)
-        if kind in self.QNAME:
-            return Multiname_QName(self._readU30(), self._readU30())
-        elif kind in self.RTQNAME:
-            return Multiname_RTQName(self._readU30())
-        elif kind in self.RTQNAMEL:
-            return Multiname_RTQNameL()
-        elif kind in self.MULTINAME:
-            return Multiname_Multiname(self._readU30(), self._readU30())
-        elif kind in self.MULTINAMEL:
-            return Multiname_MultinameL(self._readU30())
-        elif kind in self.TYPENAME: # Undocumented TypeName
-            name = self._readU30()
-            count = self._readU30()
-            params = []
-            for i in xrange(0, count):
-                params.append(self._readU30())
-            return Multiname_Typename(name, params)
+    def _intern(self, values):
+        values = tuple(values)
+        return self._interned.setdefault(values, values)
 
     def _readMethod(self):
-        param_count = self._readU30()
+        param_count = self._readCount()
         return_type = self._readU30()
-        param_types = []
-        for i in xrange(0, param_count):
-            param_types.append(self._readU30())
+        param_types = self._readU30Array(param_count)
         name = self._readU30()
         flags = self._readU8()
         option_details = []
         param_names = []
         if flags & 0x08:
-            option_count = self._readU30()
+            option_count = self._readCount(2)
             if option_count == 0 or option_count > param_count:
                 raise ABCdBadValue("Invalid option count", option_count)
             for i in xrange(0, option_count):
                 option_details.append(Option(self._readU30(), self._readU8()))
         if flags & 0x80:
-            param_names = []
-            for i in xrange(0, param_count):
-                param_names.append(self._readU30())
+            param_names = self._readU30Array(param_count)
         return Method(return_type,
                       param_types,
                       name,
@@ -376,10 +778,10 @@ class ABCParser(ABCdCommon):
         name = self._readU30()
         if name == 0:
             raise ABCdBadValue("Invalid metadata name", name)
-        item_count = self._readU30()
-        items = []
-        for i in xrange(0, item_count):
-            items.append(Metadata_Item(self._readU30(), self._readU30()))
+        # Items are key/value pairs.
+        values = self._readU30Array(self._readCount(2) * 2)
+        items = [Metadata_Item(values[i], values[i + 1])
+                 for i in xrange(0, len(values), 2)]
         return Metadata(name, items)
 
     def _readInstance(self):
@@ -389,15 +791,11 @@ class ABCParser(ABCdCommon):
         protected_ns = (False, 0)
         if flags & 0x08:
             protected_ns = (True, self._readU30())
-        intrf_count = self._readU30()
-        interfaces = []
-        for i in xrange(0, intrf_count):
-            interface = self._readU30()
-            if interface == 0:
-                raise ABCdBadValue("Invalid interface", interface)
-            interfaces.append(interface)
+        interfaces = self._readU30Array(self._readCount())
+        if 0 in interfaces:
+            raise ABCdBadValue("Invalid interface", 0)
         iinit = self._readU30()
-        trait_count = self._readU30()
+        trait_count = self._readCount(4)
         traits = []
         for i in xrange(0, trait_count):
             traits.append(self._readTrait())
@@ -411,7 +809,7 @@ class ABCParser(ABCdCommon):
 
     def _readClass(self):
         cinit = self._readU30()
-        trait_count = self._readU30()
+        trait_count = self._readCount(4)
         traits = []
         for i in xrange(0, trait_count):
             traits.append(self._readTrait())
@@ -447,59 +845,176 @@ class ABCParser(ABCdCommon):
             disp_id = self._readU30()
             method = self._readU30()
             data = Method_Trait(disp_id, method)
-        metadata = []
+        metadata = ()
         # Upper nibble are attributes
         attr = (kind & 0xF0) >> 4;
         if attr & self.ATTR_METADATA:
-            metadata_count = self._readU30()
-            for i in xrange(0, metadata_count):
-                metadata.append(self._readU30())
+            metadata = self._intern(self._readU30Array(self._readCount()))
         return Trait(name, kind, data, metadata)
 
+    # The _skip* functions mirror the _read* functions, advancing past an
+    # entry without building anything.
+    def _skipNamespaceSet(self):
+        self._skipU30(self._readCount())
+
+    def _skipMethod(self):
+        param_count = self._readCount()
+        self._readU30()
+        self._skipU30(param_count)
+        self._readU30()
+        flags = self._readU8()
+        if flags & 0x08:
+            for i in xrange(0, self._readCount(2)):
+                self._readU30()
+                self.p += 1
+        if flags & 0x80:
+            self._skipU30(param_count)
+
+    def _skipMetadata(self):
+        self._readU30()
+        self._skipU30(self._readCount(2) * 2)
+
+    def _skipTraits(self):
+        for i in xrange(0, self._readCount(4)):
+            self._readU30()
+            kind = self._readU8()
+            if (kind & 0x0F) not in self.TRAIT_KIND:
+                raise ABCdBadValue("Invalid trait kind", kind & 0x0F)
+            if (kind & 0x0F) in self.SLOT_CONST_TRAIT:
+                self._readU30()
+                self._readU30()
+                if self._readU30() != 0:
+                    self.p += 1
+            else:
+                self._skipU30(2)
+            if (kind >> 4) & self.ATTR_METADATA:
+                self._skipU30(self._readCount())
+
+    def _skipInstance(self):
+        self._skipU30(2)
+        if self._readU8() & 0x08:
+            self._readU30()
+        self._skipU30(self._readCount())
+        self._readU30()
+        self._skipTraits()
+
+    def _skipClass(self):
+        self._readU30()
+        self._skipTraits()
+
+    def _skipScript(self):
+        self._readU30()
+        self._skipTraits()
+
+    def _skipMethodBody(self):
+        self._skipU30(5)
+        code_length = self._readLength()
+        self.p += code_length
+        self._skipU30(self._readCount(5) * 5)
+        self._skipTraits()
+
     def resolve_multiname(self, index):
-        multiname = self.multinames[index]
-        if isinstance(multiname, Multiname_QName):
-            if multiname.ns == 0:
+        # Names are resolved once and memoized, the same few names are
+        # asked for over and over again.
+        if self._resolved is None:
+            self._resolved = [None] * len(self._multinames)
+        result = self._resolved[index]
+        if result is None:
+            result = self._resolve_multiname(index)
+            self._resolved[index] = result
+        return result
+
+    def resolve_multinames(self):
+        """Resolve every multiname in one pass, returning a list of names."""
+        if self._resolved is None:
+            self._resolved = [None] * len(self._multinames)
+        resolved = self._resolved
+        multinames = self._multinames
+        # QNames are the vast majority, handle them with a namespace prefix
+        # computed once per namespace.
+        prefixes = []
+        for name_index in self._namespaces.name:
+            ns = self.strings[name_index]
+            if ns != '':
+                ns += '.'
+            prefixes.append(ns)
+        prefixes[0] = "*."
+        strings = self.strings
+        for (index, kind) in enumerate(multinames.kind):
+            if resolved[index] is not None:
+                continue
+            if kind in self.QNAME:
+                name_index = multinames.name[index]
+                if name_index == 0:
+                    name = "*"
+                else:
+                    name = strings[name_index]
+                resolved[index] = "%s%s" % (prefixes[multinames.ns[index]],
+                                            name)
+            elif index != 0:
+                resolved[index] = self._resolve_multiname(index)
+        return resolved
+
+    def _resolve_multiname(self, index):
+        # Works on the multiname and namespace table columns directly rather
+        # than building an entry object for every lookup.
+        multinames = self._multinames
+        namespaces = self._namespaces
+        kind = multinames.kind[index]
+        if kind in self.QNAME:
+            ns_index = multinames.ns[index]
+            if ns_index == 0:
                 ns = "*"
             else:
-                ns = self.strings[self.namespaces[multiname.ns].name]
-            if multiname.name == 0:
+                ns = self.strings[namespaces.name[ns_index]]
+            name_index = multinames.name[index]
+            if name_index == 0:
                 name = "*"
             else:
-                name = self.strings[multiname.name]
+                name = self.strings[name_index]
             # Separate ns from name if we have a ns
             if ns != '':
                 ns += '.'
             return "%s%s" % (ns, name)
-        elif isinstance(multiname, Multiname_RTQName):
-            if multiname.name == 0:
+        elif kind in self.RTQNAME:
+            name_index = multinames.name[index]
+            if name_index == 0:
                 name = "*"
             else:
-                name = self.strings[multiname.name]
+                name = self.strings[name_index]
             return name
-        elif isinstance(multiname, Multiname_RTQNameL):
+        elif kind in self.RTQNAMEL:
             return ''
-        elif isinstance(multiname, Multiname_Multiname):
-            ns_set = self.namespacesets[multiname.ns_set]
-            name = self.strings[multiname.name]
+        elif kind in self.MULTINAME:
+            ns_set = self.namespacesets[multinames.ns_set[index]]
+            name = self.strings[multinames.name[index]]
             return "ns sets: %s name: %s" % (', '.join(str(nss) for nss in ns_set), name)
-        elif isinstance(multiname, Multiname_MultinameL):
-            ns_set = self.namespacesets[multiname.ns_set]
+        elif kind in self.MULTINAMEL:
+            ns_set = self.namespacesets[multinames.ns_set[index]]
             result = []
             for ns in ns_set:
-                namespace = self.namespaces[ns]
-                s = self.CONST_KIND[namespace.kind]
-                if namespace.name == 0:
-                    result.append("%s:%s" % (s, str(namespace.name)))
+                s = self.CONST_KIND[namespaces.kind[ns]]
+                name_index = namespaces.name[ns]
+                if name_index == 0:
+                    result.append("%s:%s" % (s, str(name_index)))
                 else:
-                    result.append("%s:%s" % (s, self.strings[namespace.name]))
+                    result.append("%s:%s" % (s, self.strings[name_index]))
             return "ns sets: %s" % ', '.join(result)
-        elif isinstance(multiname, Multiname_Typename):
-            name = self.resolve_multiname(multiname.name)
-            params = ', '.join(self.resolve_multiname(param) for param in multiname.params)
+        elif kind in self.TYPENAME:
+            name = self.resolve_multiname(multinames.name[index])
+            params = ', '.join(self.resolve_multiname(param) for param in multinames.params[index])
             return "name: %s params: %s" % (name, params) # XXX
 
     def resolve_trait(self, trait):
+        # Memoized, callers share the returned dictionary.
+        try:
+            return self._resolved_traits[trait]
+        except KeyError:
+            result = self._resolve_trait(trait)
+            self._resolved_traits[trait] = result
+            return result
+
+    def _resolve_trait(self, trait):
         if isinstance(trait.data, Slot_Trait):
             slot_id = trait.data.slot_id
             if trait.data.type_name == 0:
@@ -520,6 +1035,112 @@ class ABCParser(ABCdCommon):
             method = trait.data.method
             return {'disp_id': disp_id, 'method_index': method}
 
+    # Reverse lookups. Each index is built in one pass over the parsed data
+    # the first time it is needed, after that lookups are constant time.
+    def method_body(self, method_index):
+        """MethodBody of method_index, or None if it has no body."""
+        if self._body_index is None:
+            index = {}
+            for (i, body) in enumerate(self._method_bodies):
+                index.setdefault(body.method, i)
+            self._body_index = index
+        i = self._body_index.get(method_index)
+        if i is None:
+            return None
+        return self._method_bodies[i]
+
+    def class_index(self, name):
+        """Index of the instance and class named name, or None."""
+        # Instance names are resolved in order, only as far as needed to
+        # find name, and remembered for later lookups. Names which can not
+        # be resolved past the one looked for are never touched.
+        index = self._class_name_index
+        if name in index:
+            return index[name]
+        while self._class_names_scanned < len(self._instances):
+            i = self._class_names_scanned
+            instance_name = self.resolve_multiname(self._instances[i].name)
+            self._class_names_scanned = i + 1
+            index.setdefault(instance_name, i)
+            if instance_name == name:
+                return i
+        return None
+
+    def class_script(self, class_index):
+        """Index of the script defining class_index, or None."""
+        if self._class_script_index is None:
+            index = {}
+            for (i, script) in enumerate(self._scripts):
+                for trait in script.traits:
+                    if isinstance(trait.data, Class_Trait):
+                        index.setdefault(trait.data.classi, i)
+            self._class_script_index = index
+        return self._class_script_index.get(class_index)
+
+    def method_trait(self, method_index):
+        """Method, getter, setter or function trait of method_index.
+
+        Traits of scripts, instances and classes are searched, returns None
+        if no trait refers to the method.
+        """
+        if self._method_trait_index is None:
+            index = {}
+            for owners in (self._scripts, self._instances, self._classes):
+                for owner in owners:
+                    for trait in owner.traits:
+                        if isinstance(trait.data, Method_Trait):
+                            index.setdefault(trait.data.method, trait)
+                        elif isinstance(trait.data, Function_Trait):
+                            index.setdefault(trait.data.function, trait)
+            self._method_trait_index = index
+        return self._method_trait_index.get(method_index)
+
+    def xrefs(self, kind):
+        """XrefTable of the code locations referring to entries of kind.
+
+        kind is a key of XREF_KINDS. The first call disassembles every
+        method body once, building the tables for all kinds. Bodies which
+        fail to decode only contribute the sites before the failure, see
+        xref_errors().
+        """
+        if self._xrefs is None:
+            self._xrefs = self._build_xrefs()
+        return self._xrefs[kind]
+
+    def xref_errors(self):
+        """Dictionary of body index to the exception decoding it raised.
+
+        Only covers bodies which failed while building the xrefs() tables.
+        """
+        if self._xrefs is None:
+            self._xrefs = self._build_xrefs()
+        return self._xref_errors
+
+    def _build_xrefs(self):
+        sites = dict((kind, (array('i'), array('i'), array('i'), array('B')))
+                     for kind in self.XREF_KINDS)
+        errors = {}
+        for (i, body) in enumerate(self._method_bodies):
+            try:
+                for (kind, index, offset, opcode) in body.references():
+                    (targets, bodies, offsets, opcodes) = sites[kind]
+                    targets.append(index)
+                    bodies.append(i)
+                    offsets.append(offset)
+                    opcodes.append(opcode)
+            except ABCdException as e:
+                # Junk bodies are common in obfuscated files, the rest of
+                # the index is still worth having.
+                errors[i] = e
+        self._xref_errors = errors
+        xrefs = {}
+        for (kind, prop) in self.XREF_KINDS.iteritems():
+            (targets, bodies, offsets, opcodes) = sites[kind]
+            # Bad indexes still get their sites, the table grows to fit.
+            size = max([len(getattr(self, prop))] + [t + 1 for t in targets])
+            xrefs[kind] = XrefTable(size, targets, bodies, offsets, opcodes)
+        return xrefs
+
     def resolve_optional(self, opt):
         if opt.kind == self.CONST_INT:
             return self.ints[opt.val]
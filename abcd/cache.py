@@ -0,0 +1,233 @@
+# Copyright (c) 2015 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+
+import os
+import sys
+import stat
+import cPickle
+import tempfile
+from array import array
+from collections import OrderedDict
+
+def _private(st):
+    # Entries are unpickled, which can run code. Only trust files and
+    # directories nobody else could have written.
+    if not hasattr(os, 'getuid'):
+        return True
+    return (st.st_uid == os.getuid() and
+            not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH))
+
+class ABCCache(object):
+    """Directory of parsed ABC data, one file per entry.
+
+    Entries are named by a key made from the SHA-256 of the ABC bytes and
+    stamped with a version, an entry with another version is a miss. Once
+    the directory holds more than max_size bytes the least recently used
+    entries are removed.
+
+    Entries are pickles, so the directory must belong to the current user
+    and not be writable by anyone else, otherwise ValueError is raised.
+    Entries which do not pass the same check are misses.
+    """
+    MAGIC = 'ABCD-CACHE'
+
+    def __init__(self, directory, max_size=256 << 20):
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        if not _private(os.stat(directory)):
+            raise ValueError("Cache directory %s is writable by other users"
+                             % directory)
+        self._directory = directory
+        self._max_size = max_size
+        # Running total of the entry sizes, from the last evict() plus what
+        # was put since. Other processes may share the directory, so it is
+        # only used to decide when to look at the directory again.
+        self._size = None
+
+    @property
+    def directory(self):
+        """Directory holding the entries."""
+        return self._directory
+
+    @property
+    def max_size(self):
+        """Total size in bytes the entries are kept under."""
+        return self._max_size
+
+    def _header(self, version):
+        return '%s %s\n' % (self.MAGIC, version)
+
+    def get(self, key, version):
+        """Return the payload stored for key, or None."""
+        path = os.path.join(self._directory, key)
+        try:
+            with open(path, 'rb') as f:
+                if not _private(os.fstat(f.fileno())):
+                    return None
+                if f.readline() != self._header(version):
+                    return None
+                payload = f.read()
+            # Eviction goes by modification time, touch it on every use.
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return payload
+
+    def put(self, key, version, payload):
+        """Store payload for key, then evict entries as needed."""
+        # Write to a temporary file first so readers never see part of an
+        # entry.
+        (fd, tmp) = tempfile.mkstemp(prefix='.', dir=self._directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self._header(version))
+                f.write(payload)
+            path = os.path.join(self._directory, key)
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        if self._size is not None:
+            self._size += len(self._header(version)) + len(payload)
+        if self._size is None or self._size > self._max_size:
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until under max_size."""
+        entries = []
+        total = 0
+        for name in os.listdir(self._directory):
+            # Skip temporary files which are still being written.
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self._directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for (mtime, size, path) in entries:
+            if total <= self._max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self._size = total
+
+def _sizeof(value):
+    # Approximate memory held by a cached value.
+    if isinstance(value, array):
+        return value.itemsize * len(value)
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(_sizeof(v) for v in value)
+    return sys.getsizeof(value)
+
+class CodeCache(object):
+    """Artifacts derived from method body code, shared between parsers.
+
+    Bodies with the same code decode to the same instructions whatever
+    file they come from, so entries are kept by code digest and kind (such
+    as 'instructions'). The least recently used entries are dropped once
+    they hold more than max_size bytes. With disk, an ABCCache, entries are
+    also stored there and looked up in it on a miss.
+
+    Values are shared by everything that gets them and must not be
+    modified.
+    """
+    VERSION = 1
+
+    def __init__(self, max_size=64 << 20, disk=None):
+        self._max_size = max_size
+        self._disk = disk
+        self._entries = OrderedDict()
+        self._size = 0
+
+    @property
+    def max_size(self):
+        """Total size in bytes the entries in memory are kept under."""
+        return self._max_size
+
+    @property
+    def size(self):
+        """Approximate size in bytes of the entries in memory."""
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _disk_key(self, digest, kind):
+        return 'code-%s-%s' % (digest, kind)
+
+    def get(self, digest, kind):
+        """Return the value stored for digest and kind, or None."""
+        try:
+            entry = self._entries.pop((digest, kind))
+        except KeyError:
+            if self._disk is None:
+                return None
+            payload = self._disk.get(self._disk_key(digest, kind),
+                                     self.VERSION)
+            if payload is None:
+                return None
+            try:
+                value = cPickle.loads(payload)
+            except Exception:
+                # A damaged entry is a miss, it is overwritten by put().
+                return None
+            self._insert((digest, kind), value)
+            return value
+        # Most recently used entries are kept at the end.
+        self._entries[(digest, kind)] = entry
+        return entry[0]
+
+    def put(self, digest, kind, value):
+        """Store value for digest and kind, in memory and on disk."""
+        self._insert((digest, kind), value)
+        if self._disk is not None:
+            self._disk.put(self._disk_key(digest, kind),
+                           self.VERSION,
+                           cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+
+    def _insert(self, key, value):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= old[1]
+        size = _sizeof(value)
+        self._entries[key] = (value, size)
+        self._size += size
+        while self._size > self._max_size and len(self._entries) > 1:
+            (key, (value, size)) = self._entries.popitem(last=False)
+            self._size -= size
+
+    def clear(self):
+        """Drop all entries held in memory."""
+        self._entries.clear()
+        self._size = 0
@@ -22,74 +22,434 @@
 # SUCH DAMAGE.
 
 import struct
+import tempfile
+
+# numpy is optional. When available long runs of varints in the constant pool
+# are decoded with vectorized operations instead of one value at a time.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class ABCdException(Exception):
+    def __init__(self):
+        pass
+
+class ABCdBadValue(ABCdException):
+    def __init__(self, msg, val):
+        self.msg = msg
+        self.val = val
+
+    def __str__(self):
+        return "%s: 0x%x" % (self.msg, self.val)
+
+class ABCdBadOpcode(ABCdException):
+    def __init__(self, val):
+        self.val = val
+
+    def __str__(self):
+        return "Invalid opcode: 0x%x" % self.val
+
+class ABCdParseError(ABCdException):
+    def __init__(self, message, offset):
+        self.message = message
+        self.offset = offset
+
+    def __str__(self):
+        return "(%s) %s" % (self.message, self.offset)
+
+# Runs shorter than this are not worth the numpy setup cost.
+_NUMPY_MIN_COUNT = 64
+
+_U8 = struct.Struct("<B")
+_U16 = struct.Struct("<H")
+_U24 = struct.Struct("<HB")
+_D64 = struct.Struct("<d")
+
+class Limits(object):
+    """Caps on the work done for one ABC file, None means no cap.
+
+    max_entries caps any single count read from the data (pool sizes, trait
+    counts, switch cases and so on), max_instructions the instructions
+    decoded from one method body and max_seconds the wall time of parse().
+    """
+    def __init__(self,
+                 max_entries=None,
+                 max_instructions=None,
+                 max_seconds=None):
+        self.max_entries = max_entries
+        self.max_instructions = max_instructions
+        self.max_seconds = max_seconds
 
 class ABCdCommon(object):
+    # No instance dictionary for the record classes built on this.
+    __slots__ = ()
+
+    # Cap on any single count, see Limits.
+    _max_entries = None
+
+    # All reads are done in place with struct.unpack_from() so that self._data
+    # may be a str, bytearray, memoryview or mmap without slicing (and copying)
+    # it for every value.
+    def _view(self, offset, length):
+        try:
+            return memoryview(self._data)[offset:offset + length]
+        except TypeError:
+            # mmap only supports the old style buffer interface.
+            return buffer(self._data, offset, length)
+
     def _readString(self):
         # Strings are pascal style, utf8 encoded.
         l = self._readU30()
         if l == 0:
             return ""
 
-        from ABCParser import ABCdParseError
+        return unicode(self._readRaw(l), 'utf-8', 'replace')
+
+    def _readRaw(self, length):
+        # Copy of the next length bytes, as a str.
         try:
-            result = struct.unpack("%ss" % l, self._data[self.p:self.p + l])[0]
-        except IndexError as e:
+            result = struct.unpack_from("%ss" % length, self._data, self.p)[0]
+        except struct.error as e:
             raise ABCdParseError(str(e), self.p)
-        self.p += l
-        return unicode(result, 'utf-8', 'replace')
+        self.p += length
+        return result
+
+    def _readBytes(self, length):
+        # Return a view of the next length bytes instead of a copy.
+        result = self._view(self.p, length)
+        self.p += length
+        return result
 
     def _readD64(self):
-        from ABCParser import ABCdParseError
         try:
-            result = struct.unpack("<d", self._data[self.p:self.p + 8])[0]
-        except IndexError as e:
+            result = _D64.unpack_from(self._data, self.p)[0]
+        except struct.error as e:
             raise ABCdParseError(str(e), self.p)
         self.p += 8
         return result
 
     def _readU8(self):
-        from ABCParser import ABCdParseError
         try:
-            result = struct.unpack("<B", self._data[self.p])[0]
-        except IndexError as e:
+            result = _U8.unpack_from(self._data, self.p)[0]
+        except struct.error as e:
             raise ABCdParseError(str(e), self.p)
         self.p += 1
         return result
 
     def _readU16(self):
-        from ABCParser import ABCdParseError
         try:
-            result = struct.unpack("<H", self._data[self.p:self.p + 2])[0]
-        except IndexError as e:
+            result = _U16.unpack_from(self._data, self.p)[0]
+        except struct.error as e:
             raise ABCdParseError(str(e), self.p)
         self.p += 2
         return result
 
+    def _readCount(self, size=1):
+        # Read a U30 count of entries, each taking at least size bytes.
+        offset = self.p
+        count = self._readU30()
+        self._checkCount(count, size, offset)
+        return count
+
+    def _readPoolCount(self, size=1):
+        # Constant pool counts include the implicit first entry, which is
+        # not in the data. Returns the number of entries which are.
+        offset = self.p
+        count = max(self._readU30() - 1, 0)
+        self._checkCount(count, size, offset)
+        return count
+
+    def _readLength(self):
+        # Read a U30 length in bytes, which must fit in the remaining data.
+        offset = self.p
+        length = self._readU30()
+        if length > len(self._data) - self.p:
+            raise ABCdParseError("Length 0x%x exceeds remaining data" % length,
+                                 offset)
+        return length
+
+    def _checkCount(self, count, size, offset):
+        # Fail before looping over entries which can not possibly be there,
+        # so the work done stays proportional to the size of the data.
+        if count * size > len(self._data) - self.p:
+            raise ABCdParseError("Count 0x%x exceeds remaining data" % count,
+                                 offset)
+        if self._max_entries is not None and count > self._max_entries:
+            raise ABCdParseError("Count 0x%x exceeds max_entries" % count,
+                                 offset)
+
     def _readU30(self):
         return self._readU32() & 0x3FFFFFFF
 
     def _readU32(self):
-        result = self._readU8()
-        if (result & 0x00000080) == 0:
-            return result
-        result = result & 0x0000007F | self._readU8() << 7
-        if (result & 0x00004000) == 0:
-            return result
-        result = result & 0x00003FFF | self._readU8() << 14
-        if (result & 0x00200000) == 0:
-            return result
-        result = result & 0x001FFFFF | self._readU8() << 21
-        if (result & 0x10000000) == 0:
-            return result
-        return result & 0x0FFFFFFF | self._readU8() << 28
+        # Variable length, up to 5 bytes. This is the hottest path in the
+        # parser so the bytes are decoded inline instead of via _readU8().
+        data = self._data
+        p = self.p
+        unpack = _U8.unpack_from
+        try:
+            result = unpack(data, p)[0]
+            p += 1
+            if result & 0x00000080:
+                result = result & 0x0000007F | unpack(data, p)[0] << 7
+                p += 1
+                if result & 0x00004000:
+                    result = result & 0x00003FFF | unpack(data, p)[0] << 14
+                    p += 1
+                    if result & 0x00200000:
+                        result = result & 0x001FFFFF | unpack(data, p)[0] << 21
+                        p += 1
+                        if result & 0x10000000:
+                            result = result & 0x0FFFFFFF | unpack(data, p)[0] << 28
+                            p += 1
+        except struct.error as e:
+            raise ABCdParseError(str(e), p)
+        self.p = p
+        return result
+
+    def _readU30Array(self, count):
+        # Read a run of count U30 values. The worst case number of bytes is
+        # copied out once and decoded as integers, which is much cheaper than
+        # count calls to _readU30().
+        if count == 0:
+            return []
+        chunk = bytearray(self._view(self.p, count * 5))
+        result = []
+        append = result.append
+        i = 0
+        try:
+            for x in xrange(0, count):
+                value = chunk[i]
+                i += 1
+                if value & 0x00000080:
+                    value = value & 0x0000007F | chunk[i] << 7
+                    i += 1
+                    if value & 0x00004000:
+                        value = value & 0x00003FFF | chunk[i] << 14
+                        i += 1
+                        if value & 0x00200000:
+                            value = value & 0x001FFFFF | chunk[i] << 21
+                            i += 1
+                            if value & 0x10000000:
+                                value = value & 0x0FFFFFFF | chunk[i] << 28
+                                i += 1
+                append(value & 0x3FFFFFFF)
+        except IndexError:
+            raise ABCdParseError("U30 array truncated", self.p + i)
+        self.p += i
+        return result
+
+    def _skipU30(self, count=1):
+        # Advance past count U30 values without decoding them.
+        chunk = bytearray(self._view(self.p, count * 5))
+        i = 0
+        try:
+            for x in xrange(0, count):
+                end = i + 4
+                while chunk[i] & 0x80 and i < end:
+                    i += 1
+                i += 1
+        except IndexError:
+            raise ABCdParseError("U30 array truncated", self.p + i)
+        self.p += i
+
+    def _decodeU32Run(self, count):
+        # Vectorized equivalent of count _readU32() calls, starting at the
+        # current offset. Value boundaries are found by masking the high bit
+        # of every byte at once. Returns (values, lengths, size) as numpy
+        # arrays of uint64 values and per value byte lengths plus the total
+        # number of bytes, without advancing. Returns None if numpy is not
+        # available, the run is too short to bother or it needs the pure
+        # python path (truncated data or a 5 byte value whose last byte has
+        # the high bit set) so the caller can fall back.
+        if numpy is None or count < _NUMPY_MIN_COUNT:
+            return None
+        available = min(count * 5, len(self._data) - self.p)
+        if available < count:
+            return None
+        if isinstance(self._data, memoryview):
+            # Python 2 numpy.frombuffer() only takes the old buffer
+            # interface, asarray() maps a memoryview without copying.
+            buf = numpy.asarray(self._data)[self.p:self.p + available]
+            if buf.dtype != numpy.uint8:
+                return None
+        else:
+            buf = numpy.frombuffer(self._data, numpy.uint8, available, self.p)
+        ends = numpy.flatnonzero(buf < 0x80)
+        if len(ends) < count:
+            return None
+        ends = ends[:count]
+        starts = numpy.empty(count, numpy.intp)
+        starts[0] = 0
+        starts[1:] = ends[:-1] + 1
+        lengths = ends - starts + 1
+        if lengths.max() > 5:
+            return None
+        size = int(ends[-1]) + 1
+        shifts = (numpy.arange(size) - numpy.repeat(starts, lengths)) * 7
+        values = ((buf[:size] & 0x7F).astype(numpy.uint64)
+                  << shifts.astype(numpy.uint64))
+        return (numpy.bitwise_or.reduceat(values, starts), lengths, size)
 
     def _readS32(self):
-        result = self._readU32()
-        if result & 0xFFFFFFFF00000000:
-            return result | 0xFFFFFFF000000000
+        # Sign extend from bit 31.
+        result = self._readU32() & 0xFFFFFFFF
+        if result & 0x80000000:
+            return result - 0x100000000
         else:
             return result
 
     def _readS24(self):
-        return self._readU8() | self._readU8() << 8 | self._readU8() << 16
+        try:
+            (low, high) = _U24.unpack_from(self._data, self.p)
+        except struct.error as e:
+            raise ABCdParseError(str(e), self.p)
+        self.p += 3
+        # Sign extend from bit 23.
+        result = low | high << 16
+        if result & 0x800000:
+            return result - 0x1000000
+        else:
+            return result
+
+class Cursor(ABCdCommon):
+    """Standalone read position over ABC data."""
+    def __init__(self, data, p=0):
+        self._data = data
+        self.p = p
+
+class StreamData(object):
+    """Sliding window over ABC data in a file-like object.
+
+    Only about window_size bytes are held in memory at once, more only for a
+    single _readRaw() which needs it. Objects which can not seek are spilled
+    to a temporary file first.
+    """
+    # Primitive readers, with the number of bytes they may need given their
+    # arguments. Everything else is built on top of these.
+    _PRIMITIVES = [('_readU8', lambda: 1),
+                   ('_readU16', lambda: 2),
+                   ('_readS24', lambda: 3),
+                   ('_readU32', lambda: 5),
+                   ('_readD64', lambda: 8),
+                   ('_readRaw', lambda length: length),
+                   ('_readU30Array', lambda count: count * 5),
+                   ('_skipU30', lambda count=1: count * 5)]
+    # U30 runs are split into batches which fit in the window, with whether
+    # the batches return values to join.
+    _BATCHED = [('_readU30Array', True),
+                ('_skipU30', False)]
+
+    def __init__(self, f, window_size=1 << 20):
+        try:
+            start = f.tell()
+            f.seek(0, 2)
+            end = f.tell()
+        except (AttributeError, IOError):
+            spill = tempfile.TemporaryFile()
+            while True:
+                chunk = f.read(window_size)
+                if not chunk:
+                    break
+                spill.write(chunk)
+            f = spill
+            start = 0
+            end = f.tell()
+        self._file = f
+        self._start = start
+        self._size = end - start
+        self._window_size = window_size
+        self._base = 0
+        self._buf = ''
+
+    def __len__(self):
+        return self._size
+
+    def window(self, offset, length):
+        """Return (buffer, base) with buffer holding length bytes at offset.
+
+        The buffer is shorter at the end of the data. base is the offset of
+        the start of the buffer.
+        """
+        end = min(offset + length, self._size)
+        if offset < self._base or end > self._base + len(self._buf):
+            self._file.seek(self._start + offset)
+            self._buf = self._file.read(max(length, self._window_size))
+            self._base = offset
+        return (self._buf, self._base)
+
+    def read(self, offset, length):
+        """Copy of length bytes at offset, read straight from the file."""
+        self._file.seek(self._start + offset)
+        return self._file.read(length)
+
+    def bind(self, reader):
+        """Route the primitive reads of reader (an ABCdCommon) through the
+        window. reader keeps using absolute offsets."""
+        for (name, need) in self._PRIMITIVES:
+            setattr(reader,
+                    name,
+                    self._windowed(reader, getattr(reader, name), need))
+        for (name, collect) in self._BATCHED:
+            setattr(reader,
+                    name,
+                    self._batched(getattr(reader, name), collect))
+        reader._view = self._viewer(reader)
+        # A vectorized run needs all of its bytes at once.
+        reader._decodeU32Run = lambda count: None
+
+    def unbind(self, reader):
+        """Undo bind(), reader goes back to reading its own _data."""
+        for (name, need) in self._PRIMITIVES:
+            delattr(reader, name)
+        del reader._view
+        del reader._decodeU32Run
+
+    def _viewer(self, reader):
+        stream = self
+        view = ABCdCommon._view
+        def viewer(offset, length):
+            if reader._data is stream:
+                return stream.read(offset, length)
+            # Inside a primitive, offsets are relative to the window.
+            return view(reader, offset, length)
+        return viewer
+
+    def _batched(self, func, collect):
+        step = max(1, self._window_size // 5)
+        def batched(count=1):
+            result = []
+            while count > 0:
+                n = min(count, step)
+                values = func(n)
+                if collect:
+                    result.extend(values)
+                count -= n
+            if collect:
+                return result
+        return batched
 
+    def _windowed(self, reader, func, need):
+        stream = self
+        def windowed(*args):
+            if reader._data is not stream:
+                # Called from another primitive, already windowed.
+                return func(*args)
+            p = reader.p
+            (buf, base) = stream.window(p, need(*args))
+            reader._data = buf
+            reader.p = p - base
+            try:
+                return func(*args)
+            except ABCdParseError as e:
+                e.offset += base
+                raise
+            finally:
+                reader.p += base
+                reader._data = stream
+                # Do not hold on to a buffer grown for one large read.
+                if len(stream._buf) > stream._window_size:
+                    stream._buf = ''
+                    stream._base = 0
+        return windowed
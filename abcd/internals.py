@@ -21,9 +21,311 @@
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
 
-from common import ABCdCommon
+import hashlib
+from array import array
+from bisect import bisect_right
+
+from common import ABCdCommon, ABCdException, ABCdBadValue, ABCdBadOpcode
+from common import ABCdParseError, Cursor
+
+# What the operands resolved by each MethodBody handler refer to, as the
+# kind of entry and how many of the operands do (None for all of them).
+_XREF_HANDLERS = {'_operands_string': ('string', None),
+                  '_operands_int': ('int', None),
+                  '_operands_uint': ('uint', None),
+                  '_operands_double': ('double', None),
+                  '_operands_namespace': ('namespace', None),
+                  '_operands_multiname': ('multiname', None),
+                  '_operands_method_info': ('method', None),
+                  '_operands_multiname_and_arg': ('multiname', 1),
+                  '_operands_method_info_and_arg': ('method', 1)}
+
+class LazyList(object):
+    """List of entries which are parsed from their offset when accessed."""
+    def __init__(self, parser, offsets, reader, head):
+        self._parser = parser
+        self._offsets = offsets
+        self._reader = reader
+        # Entries which are not in the data, like the implicit first entry
+        # of the constant pools.
+        self._head = list(head)
+        self._entries = [None] * len(offsets)
+
+    def __len__(self):
+        return len(self._head) + len(self._offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < len(self._head):
+            return self._head[index]
+        i = index - len(self._head)
+        if i < 0 or i >= len(self._offsets):
+            raise IndexError("LazyList index out of range")
+        entry = self._entries[i]
+        if entry is None:
+            entry = self._build(i)
+            self._entries[i] = entry
+        return entry
+
+    def _build(self, i):
+        return self._parser._read_at(self._offsets[i], self._reader)
+
+    def __getstate__(self):
+        # The reader is a method of the parser, keep its name instead.
+        state = self.__dict__.copy()
+        if self._reader is not None:
+            state['_reader'] = self._reader.__name__
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._reader is not None:
+            self._reader = getattr(self._parser, self._reader)
+
+    def __iter__(self):
+        for i in xrange(0, len(self)):
+            yield self[i]
+
+    @property
+    def offsets(self):
+        """Array of byte offsets for each entry."""
+        return self._offsets
+
+class StringPool(LazyList):
+    """String constant pool, decoded from UTF-8 only when accessed."""
+    def __init__(self, parser, offsets, lengths, head):
+        LazyList.__init__(self, parser, offsets, None, head)
+        self._lengths = lengths
+
+    def _build(self, i):
+        if self._lengths[i] == 0:
+            return ""
+        return unicode(self._raw(i), 'utf-8', 'replace')
+
+    def _raw(self, i):
+        return self._parser._read_at(self._offsets[i],
+                                     self._parser._readRaw,
+                                     self._lengths[i])
+
+    def raw(self, index):
+        """Undecoded bytes of the string at index."""
+        if index < 0:
+            index += len(self)
+        if index < len(self._head):
+            return str(self._head[index])
+        i = index - len(self._head)
+        if i < 0 or i >= len(self._offsets):
+            raise IndexError("StringPool index out of range")
+        return self._raw(i)
+
+    @property
+    def lengths(self):
+        """Array of byte lengths for each entry."""
+        return self._lengths
+
+class Table(object):
+    """Base for tables stored as parallel arrays, one array per field.
+
+    Indexing a table builds a small object for that entry, the arrays can
+    be used directly where that is too slow.
+    """
+    def __len__(self):
+        return len(self.kind)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("%s index out of range" % type(self).__name__)
+        return self._entry(index)
+
+    def __iter__(self):
+        for i in xrange(0, len(self)):
+            yield self._entry(i)
+
+class NamespaceTable(Table):
+    """Namespaces as parallel kind and name arrays."""
+    def __init__(self):
+        # Entry 0 is the implicit empty namespace. U30 values fit in 'i',
+        # which gives back ints rather than longs.
+        self.kind = array('B', [0])
+        self.name = array('i', [0])
+
+    def append(self, kind, name):
+        self.kind.append(kind)
+        self.name.append(name)
+
+    def clear(self):
+        """Remove all entries but the implicit first one."""
+        del self.kind[1:]
+        del self.name[1:]
+
+    def _entry(self, i):
+        return Namespace(self.kind[i], self.name[i])
+
+class MultinameTable(Table):
+    """Multinames as parallel kind, ns, name and ns_set arrays.
+
+    Fields which do not apply to a multiname kind are zero. TypeName
+    parameters are kept in the params dictionary, keyed by index.
+    """
+    def __init__(self):
+        # Entry 0 is the implicit empty multiname, kind 0 is not valid.
+        self.kind = array('B', [0])
+        self.ns = array('i', [0])
+        self.name = array('i', [0])
+        self.ns_set = array('i', [0])
+        self.params = {}
+
+    def append(self, kind, ns=0, name=0, ns_set=0, params=None):
+        if params is not None:
+            self.params[len(self.kind)] = params
+        self.kind.append(kind)
+        self.ns.append(ns)
+        self.name.append(name)
+        self.ns_set.append(ns_set)
+
+    def clear(self):
+        """Remove all entries but the implicit first one."""
+        del self.kind[1:]
+        del self.ns[1:]
+        del self.name[1:]
+        del self.ns_set[1:]
+        self.params.clear()
+
+    def _entry(self, i):
+        kind = self.kind[i]
+        if kind in (0x07, 0x0D):
+            return Multiname_QName(self.ns[i], self.name[i])
+        elif kind in (0x0F, 0x10):
+            return Multiname_RTQName(self.name[i])
+        elif kind in (0x11, 0x12):
+            return Multiname_RTQNameL()
+        elif kind in (0x09, 0x0E):
+            return Multiname_Multiname(self.name[i], self.ns_set[i])
+        elif kind in (0x1B, 0x1C):
+            return Multiname_MultinameL(self.ns_set[i])
+        elif kind == 0x1D:
+            return Multiname_Typename(self.name[i], self.params[i])
+        return []
+
+class InstructionTable(Table):
+    """Instructions of a method body as parallel arrays.
+
+    offset and opcode have one entry per instruction. The operands of
+    instruction i are operands[operand_start[i]:operand_start[i + 1]], as
+    they are in the code. Indexing builds the OpCode disassemble() yields
+    for that instruction.
+    """
+    def __init__(self, body, columns=None):
+        self._body = body
+        if columns is None:
+            columns = (array('i'), array('B'), array('i', [0]), array('i'))
+        (self.offset,
+         self.opcode,
+         self.operand_start,
+         self.operands) = columns
+
+    def __len__(self):
+        return len(self.opcode)
+
+    @property
+    def columns(self):
+        """Tuple of the offset, opcode, operand_start and operands arrays."""
+        return (self.offset, self.opcode, self.operand_start, self.operands)
+
+    def append(self, offset, opcode, operands):
+        self.offset.append(offset)
+        self.opcode.append(opcode)
+        self.operands.extend(operands)
+        self.operand_start.append(len(self.operands))
+
+    def _entry(self, i):
+        operands = self.operands[self.operand_start[i]:
+                                 self.operand_start[i + 1]].tolist()
+        offset = self.offset[i]
+        if i + 1 < len(self.offset):
+            end = self.offset[i + 1]
+        else:
+            end = len(self._body.code)
+        return self._body._opcode(self.opcode[i], operands, offset,
+                                  end - offset)
+
+class XrefTable(object):
+    """Code locations referring to each entry of a pool, or to methods.
+
+    Sites are kept in parallel body, offset and opcode arrays, sorted by
+    the entry they refer to. The sites of entry i are from start[i] up to
+    start[i + 1], so looking one up does not depend on the number of sites.
+    """
+    def __init__(self, size, targets, bodies, offsets, opcodes):
+        # Counting sort of the sites by target.
+        start = array('i', [0]) * (size + 1)
+        for target in targets:
+            start[target + 1] += 1
+        for i in xrange(0, size):
+            start[i + 1] += start[i]
+        fill = array('i', start)
+        self.start = start
+        self.body = array('i', [0]) * len(targets)
+        self.offset = array('i', [0]) * len(targets)
+        self.opcode = array('B', [0]) * len(targets)
+        for (j, target) in enumerate(targets):
+            k = fill[target]
+            fill[target] = k + 1
+            self.body[k] = bodies[j]
+            self.offset[k] = offsets[j]
+            self.opcode[k] = opcodes[j]
+
+    def __len__(self):
+        return len(self.start) - 1
+
+    def __getitem__(self, index):
+        """List of (body index, instruction offset, opcode) for index."""
+        if index < 0 or index >= len(self):
+            return []
+        return [(self.body[k], self.offset[k], self.opcode[k])
+                for k in xrange(self.start[index], self.start[index + 1])]
+
+class ControlFlowGraph(object):
+    """Basic blocks of a method body and the edges between them.
+
+    Block i starts at code offset start[i] and runs up to start[i + 1], the
+    last one up to the end of the code. Its successors are the block
+    indexes successor[edge_start[i]:edge_start[i + 1]], including the
+    handlers of the exceptions covering it.
+    """
+    def __init__(self, start, edge_start, successor):
+        self.start = start
+        self.edge_start = edge_start
+        self.successor = successor
+
+    def __len__(self):
+        return len(self.start)
+
+    def successors(self, index):
+        """List of block indexes block index may continue in."""
+        return self.successor[self.edge_start[index]:
+                              self.edge_start[index + 1]].tolist()
+
+    def block_index(self, offset):
+        """Index of the block covering code offset, or -1 before the first."""
+        return bisect_right(self.start, offset) - 1
+
+    def edges(self):
+        """Generator for (from, to) block index pairs."""
+        for i in xrange(0, len(self.start)):
+            for k in xrange(self.edge_start[i], self.edge_start[i + 1]):
+                yield (i, self.successor[k])
 
 class Namespace(object):
+    __slots__ = ('_kind', '_name')
+
     def __init__(self, kind, name):
         self._kind = kind
         self._name = name
@@ -39,6 +341,8 @@ class Namespace(object):
         return self._name
 
 class Multiname_QName(object):
+    __slots__ = ('_ns', '_name')
+
     def __init__(self, ns, name):
         self._ns = ns
         self._name = name
@@ -54,6 +358,8 @@ class Multiname_QName(object):
         return self._name
 
 class Multiname_RTQName(object):
+    __slots__ = ('_name',)
+
     def __init__(self, name):
         self._name = name
 
@@ -63,10 +369,14 @@ class Multiname_RTQName(object):
         return self._name
 
 class Multiname_RTQNameL(object):
+    __slots__ = ()
+
     def __init__(self):
         pass
 
 class Multiname_Multiname(object):
+    __slots__ = ('_name', '_ns_set')
+
     def __init__(self, name, ns_set):
         if ns_set == 0:
             raise ABCdBadValue("Invalid ns_set", ns_set)
@@ -84,6 +394,8 @@ class Multiname_Multiname(object):
         return self._ns_set
 
 class Multiname_MultinameL(object):
+    __slots__ = ('_ns_set',)
+
     def __init__(self, ns_set):
         if ns_set == 0:
             raise ABCdBadValue("Invalid ns_set", ns_set)
@@ -96,6 +408,8 @@ class Multiname_MultinameL(object):
 
 # Where is this documented?
 class Multiname_Typename(object):
+    __slots__ = ('_name', '_params')
+
     def __init__(self, name, params):
         self._name = name
         self._params = params
@@ -111,6 +425,9 @@ class Multiname_Typename(object):
         return self._params
 
 class Method(ABCdCommon):
+    __slots__ = ('_return_type', '_param_types', '_name', '_flags',
+                 '_options', '_param_names', '_parser')
+
     def __init__(self,
                  return_type,
                  param_types,
@@ -158,6 +475,9 @@ class Method(ABCdCommon):
         return self._param_names
 
     def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def __unicode__(self):
         # XXX: Deal with parameter names and optionals...
         if self.return_type == 0:
             return_type = "*"
@@ -175,9 +495,11 @@ class Method(ABCdCommon):
                 pt.append("*")
             else:
                 pt.append(self._parser.resolve_multiname(param_type))
-        return "%s %s(%s)" % (return_type, method_name, ', '.join(pt))
+        return u"%s %s(%s)" % (return_type, method_name, u', '.join(pt))
 
 class Metadata(object):
+    __slots__ = ('_name', '_items')
+
     def __init__(self, name, items):
         self._name = name
         self._items = items
@@ -193,6 +515,8 @@ class Metadata(object):
         return self._items
 
 class Metadata_Item(object):
+    __slots__ = ('_key', '_value')
+
     def __init__(self, key, value):
         self._key = key
         self._value = value
@@ -208,6 +532,8 @@ class Metadata_Item(object):
         return self._value
 
 class Option(object):
+    __slots__ = ('_val', '_kind')
+
     def __init__(self, val, kind):
         self._val = val
         self._kind = kind
@@ -223,6 +549,9 @@ class Option(object):
         return self._kind
 
 class Instance(object):
+    __slots__ = ('_name', '_super_name', '_flags', '_protected_ns',
+                 '_interfaces', '_iinit', '_traits')
+
     def __init__(self,
                  name,
                  super_name,
@@ -275,6 +604,8 @@ class Instance(object):
         return self._traits
 
 class Class(object):
+    __slots__ = ('_cinit', '_traits')
+
     def __init__(self, cinit, traits):
         self._cinit = cinit
         self._traits = traits
@@ -290,6 +621,8 @@ class Class(object):
         return self._traits
 
 class Script(object):
+    __slots__ = ('_init', '_traits')
+
     def __init__(self, init, traits):
         self._init = init
         self._traits = traits
@@ -305,10 +638,25 @@ class Script(object):
         return self._traits
 
 class OpCode(object):
-    def __init__(self, opcode, operands, name):
+    __slots__ = ('_opcode', '_raw', '_operands', '_name', '_body', '_handler',
+                 '_error', '_offset', '_size')
+
+    def __init__(self, opcode, operands, name, body=None, handler=None,
+                 offset=None, size=None):
         self._opcode = opcode
-        self._operands = operands
+        self._raw = operands
         self._name = name
+        self._offset = offset
+        self._size = size
+        # With a handler, operands are resolved by the body the first time
+        # they are accessed.
+        self._body = body
+        self._handler = handler
+        self._error = None
+        if handler is None:
+            self._operands = operands
+        else:
+            self._operands = None
 
     @property
     def opcode(self):
@@ -317,15 +665,357 @@ class OpCode(object):
 
     @property
     def operands(self):
-        """List of operands."""
+        """List of operands, with indexes resolved to names and constants."""
+        if self._operands is None:
+            self._resolve()
         return self._operands
 
+    @property
+    def raw_operands(self):
+        """List of operands as they are in the code."""
+        return self._raw
+
+    @property
+    def error(self):
+        """Exception raised resolving operands, or None.
+
+        Operands which could not be resolved are left as they are in the
+        code.
+        """
+        if self._operands is None:
+            self._resolve()
+        return self._error
+
+    def _resolve(self):
+        try:
+            self._operands = getattr(self._body, self._handler)(self._raw)
+        except (IndexError, KeyError, UnicodeError, ABCdException) as e:
+            self._operands = self._raw
+            self._error = e
+
     @property
     def name(self):
         """Instruction name."""
         return self._name
 
+    @property
+    def offset(self):
+        """Offset of the instruction in the method body code."""
+        return self._offset
+
+    @property
+    def size(self):
+        """Length of the instruction in bytes, operands included."""
+        return self._size
+
+    @property
+    def targets(self):
+        """List of code offsets this instruction may branch to.
+
+        Branch operands are relative, to the next instruction for jump and
+        the if instructions and to this one for lookupswitch. The default
+        case of a lookupswitch comes first. Empty for other instructions.
+        """
+        if self._opcode in _BRANCHES:
+            return [self._offset + self._size + self._raw[0]]
+        elif self._opcode == 0x1B: # lookupswitch
+            return [self._offset + self._raw[0]] + \
+                   [self._offset + delta for delta in self._raw[2:]]
+        return []
+
+# Branch instructions with a single S24 operand: ifnlt (0x0C) through
+# ifstrictne (0x1A), jump included.
+_BRANCHES = frozenset(xrange(0x0C, 0x1B))
+
+# Instructions after which execution does not continue with the next one:
+# throw, jump, lookupswitch, returnvoid and returnvalue.
+_NO_FALLTHROUGH = frozenset([0x03, 0x10, 0x1B, 0x47, 0x48])
+
+# Operand readers used by the opcode table, called with the cursor to read
+# from.
+_readU8 = ABCdCommon.__dict__['_readU8']
+_readU30 = ABCdCommon.__dict__['_readU30']
+_readS24 = ABCdCommon.__dict__['_readS24']
+
+# The "ActionScript Virtual Machine 2 (AVM2) Overview" documentation
+# published by Adobe was last updated in 2007 and does not contain
+# all instructions. Looks like https://github.com/adobe-flash/avmplus
+# has a lot of the missing ones.
+_OPCODES = {
+    # These are the ones not mentioned in official documentation.
+    # These are prefixed with 'OP_' to visually stand out.
+    0x01: {'name': 'OP_bkpt', 'operands': []},
+    0x22: {'name': 'OP_pushconstant', 'operands': []},
+    0x35: {'name': 'OP_li8', 'operands': []},
+    0x36: {'name': 'OP_li16', 'operands': []},
+    0x37: {'name': 'OP_li32', 'operands': []},
+    0x38: {'name': 'OP_lf32', 'operands': []},
+    0x39: {'name': 'OP_lf64', 'operands': []},
+    0x3A: {'name': 'OP_si8', 'operands': []},
+    0x3B: {'name': 'OP_si16', 'operands': []},
+    0x3C: {'name': 'OP_si32', 'operands': []},
+    0x3D: {'name': 'OP_sf32', 'operands': []},
+    0x3E: {'name': 'OP_sf64', 'operands': []},
+    0x4B: {'name': 'OP_callsuperid', 'operands': []},
+    0x4D: {'name': 'OP_callinterface', 'operands': []},
+    0x50: {'name': 'OP_sxi1', 'operands': []},
+    0x51: {'name': 'OP_sxi8', 'operands': []},
+    0x52: {'name': 'OP_sxi16', 'operands': []},
+    0x53: {'name': 'OP_applytype', 'operands': [_readU30]},
+    0x5F: {'name': 'OP_finddef', 'operands': [_readU30]},
+    0x67: {'name': 'OP_getouterscope', 'operands': []},
+    0x6B: {'name': 'OP_deletepropertylate', 'operands': []},
+    0x81: {'name': 'OP_coerce_b', 'operands': []},
+    0x83: {'name': 'OP_coerce_i', 'operands': []},
+    0x84: {'name': 'OP_coerce_d', 'operands': []},
+    0x84: {'name': 'OP_coerce_d', 'operands': []},
+    0x88: {'name': 'OP_coerce_u', 'operands': []},
+    0x89: {'name': 'OP_coerce_o', 'operands': []},
+    0x9A: {'name': 'OP_concat', 'operands': []},
+    0x9B: {'name': 'OP_add_d', 'operands': []},
+    0xF2: {'name': 'OP_bkptline', 'operands': [_readU30]},
+    0xF3: {'name': 'OP_timestamp', 'operands': []},
+    # And now with the documented ones...
+    0xA0: {'name': 'add', 'operands': []},
+    0xC5: {'name': 'add_i', 'operands': []},
+    0x86: {'name': 'astype', 'operands': []},
+    0x87: {'name': 'astypelate', 'operands': []},
+    0xA8: {'name': 'bitand', 'operands': []},
+    0x97: {'name': 'bitnot', 'operands': []},
+    0xA9: {'name': 'bitor', 'operands': []},
+    0xAA: {'name': 'bitxor', 'operands': []},
+    0x41: {'name': 'call', 'operands': [_readU30]},
+    0x43: {'name': 'callmethod', 'operands': [_readU30,
+                                              _readU30]},
+    0x46: {'name': 'callproperty',
+           'operands': [_readU30, _readU30],
+           'handler': '_operands_multiname_and_arg'},
+    0x4C: {'name': 'callproplex',
+           'operands': [_readU30, _readU30],
+           'handler': '_operands_multiname_and_arg'},
+    0x4F: {'name': 'callpropvoid',
+           'operands': [_readU30, _readU30],
+           'handler': '_operands_multiname_and_arg'},
+    0x44: {'name': 'callstatic',
+           'operands': [_readU30, _readU30],
+           'handler': '_operands_method_info_and_arg'},
+    0x45: {'name': 'callsuper',
+           'operands': [_readU30, _readU30],
+           'handler': '_operands_multiname_and_arg'},
+    0x4E: {'name': 'callsupervoid',
+           'operands': [_readU30, _readU30],
+           'handler': '_operands_multiname_and_arg'},
+    0x78: {'name': 'checkfilter', 'operands': []},
+    0x80: {'name': 'coerce',
+           'operands': [_readU30],
+           'handler': '_operands_multiname'},
+    0x82: {'name': 'coerce_a', 'operands': []},
+    0x85: {'name': 'coerce_s', 'operands': []},
+    0x42: {'name': 'construct', 'operands': [_readU30]},
+    0x4A: {'name': 'constructprop',
+           'operands': [_readU30, _readU30],
+           'handler': '_operands_multiname_and_arg'},
+    0x49: {'name': 'constructsuper', 'operands': [_readU30]},
+    0x76: {'name': 'convert_b', 'operands': []},
+    0x73: {'name': 'convert_i', 'operands': []},
+    0x75: {'name': 'convert_d', 'operands': []},
+    0x77: {'name': 'convert_o', 'operands': []},
+    0x74: {'name': 'convert_u', 'operands': []},
+    0x70: {'name': 'convert_s', 'operands': []},
+    # XXX: Add a handler for this.
+    0xEF: {'name': 'debug', 'operands': [_readU8,
+                                         _readU30,
+                                         _readU8,
+                                         _readU30]},
+    0xF1: {'name': 'debugfile',
+           'operands': [_readU30],
+           'handler': '_operands_string'},
+    0xF0: {'name': 'debugline', 'operands': [_readU30]},
+    0x94: {'name': 'declocal', 'operands': [_readU30]},
+    0xC3: {'name': 'declocal_i', 'operands': [_readU30]},
+    0x93: {'name': 'decrement', 'operands': []},
+    0xC1: {'name': 'decrement_i', 'operands': []},
+    0x6A: {'name': 'deleteproperty',
+           'operands': [_readU30],
+           'handler': '_operands_multiname'},
+    0xA3: {'name': 'divide', 'operands': []},
+    0x2A: {'name': 'dup', 'operands': []},
+    0x06: {'name': 'dxns',
+           'operands': [_readU30],
+           'handler': '_operands_string'},
+    0x07: {'name': 'dxnslate', 'operands': []},
+    0xAB: {'name': 'equals', 'operands': []},
+    0x72: {'name': 'esc_xattr', 'operands': []},
+    0x71: {'name': 'esc_xelem', 'operands': []},
+    0x5E: {'name': 'findproperty',
+           'operands': [_readU30],
+           'handler': '_operands_multiname'},
+    0x5D: {'name': 'findpropstrict',
+           'operands': [_readU30],
+           'handler': '_operands_multiname'},
+    0x59: {'name': 'getdescendants',
+           'operands': [_readU30],
+           'handler': '_operands_multiname'},
+    0x64: {'name': 'getglobalscope', 'operands': []},
+    0x6E: {'name': 'getglobalslot', 'operands': [_readU30]},
+    0x60: {'name': 'getlex',
+           'operands': [_readU30],
+           'handler': '_operands_multiname'},
+    0x62: {'name': 'getlocal', 'operands': [_readU30]},
+    0xD0: {'name': 'getlocal_0', 'operands': []},
+    0xD1: {'name': 'getlocal_1', 'operands': []},
+    0xD2: {'name': 'getlocal_2', 'operands': []},
+    0xD3: {'name': 'getlocal_3', 'operands': []},
+    0x66: {'name': 'getproperty',
+           'operands': [_readU30],
+           'handler': '_operands_multiname'},
+    0x65: {'name': 'getscopeobject', 'operands': [_readU8]},
+    0x6C: {'name': 'getslot', 'operands': [_readU30]},
+    0x04: {'name': 'getsuper',
+           'operands': [_readU30],
+           'handler': '_operands_multiname'},
+    # Docs list 0xAF twice... :(
+    # 0xAF is greaterthan, 0xB0 is greaterequals.
+    0xAF: {'name': 'greaterthan', 'operands': []},
+    0xB0: {'name': 'greaterequals', 'operands': []},
+    0x1F: {'name': 'hasnext', 'operands': []},
+    0x32: {'name': 'hasnext2', 'operands': [_readU30,
+                                            _readU30]},
+    0x13: {'name': 'ifeq', 'operands': [_readS24]},
+    0x12: {'name': 'iffalse', 'operands': [_readS24]},
+    0x18: {'name': 'ifge', 'operands': [_readS24]},
+    0x17: {'name': 'ifgt', 'operands': [_readS24]},
+    0x16: {'name': 'ifle', 'operands': [_readS24]},
+    0x15: {'name': 'iflt', 'operands': [_readS24]},
+    0x0F: {'name': 'ifnge', 'operands': [_readS24]},
+    0x0E: {'name': 'ifngt', 'operands': [_readS24]},
+    0x0D: {'name': 'ifnle', 'operands': [_readS24]},
+    0x0C: {'name': 'ifnlt', 'operands': [_readS24]},
+    0x14: {'name': 'ifne', 'operands': [_readS24]},
+    0x19: {'name': 'ifstricteq', 'operands': [_readS24]},
+    0x1A: {'name': 'ifstrictne', 'operands': [_readS24]},
+    0x11: {'name': 'iftrue', 'operands': [_readS24]},
+    0xB4: {'name': 'in', 'operands': []},
+    0x92: {'name': 'inclocal', 'operands': [_readU30]},
+    0xC2: {'name': 'inclocal_i', 'operands': [_readU30]},
+    0x91: {'name': 'increment', 'operands': []},
+    0xC0: {'name': 'increment_i', 'operands': []},
+    0x68: {'name': 'initproperty',
+           'operands': [_readU30],
+           'handler': '_operands_multiname'},
+    0xB1: {'name': 'instanceof', 'operands': []},
+    0xB2: {'name': 'istype',
+           'operands': [_readU30],
+           'handler': '_operands_multiname'},
+    0xB3: {'name': 'istypelate', 'operands': []},
+    0x10: {'name': 'jump', 'operands': [_readS24]},
+    0x08: {'name': 'kill', 'operands': [_readU30]},
+    0x09: {'name': 'label', 'operands': []},
+    0xAE: {'name': 'lessequals', 'operands': []},
+    0xAD: {'name': 'lessthan', 'operands': []},
+    0x34: {'name': 'pushdnan', 'operands': []},
+    # Variable length operands! :(
+    # default_offset, case_count, case_offsets...
+    0x1B: {'name': 'lookupswitch', 'operands': [_readS24,
+                                                _readU30]},
+    0xA5: {'name': 'lshift', 'operands': []},
+    0xA4: {'name': 'modulo', 'operands': []},
+    0xA2: {'name': 'multiply', 'operands': []},
+    0xC7: {'name': 'multiply_i', 'operands': []},
+    0x90: {'name': 'negate', 'operands': []},
+    0xC4: {'name': 'negate_i', 'operands': []},
+    0x57: {'name': 'newactivation', 'operands': []},
+    0x56: {'name': 'newarray', 'operands': [_readU30]},
+    0x5A: {'name': 'newcatch',
+           'operands': [_readU30],
+           'handler': '_operands_exception'},
+    # XXX: Handle operands for newclass...
+    0x58: {'name': 'newclass', 'operands': [_readU30]},
+    0x40: {'name': 'newfunction',
+           'operands': [_readU30],
+           'handler': '_operands_method_info'},
+    0x55: {'name': 'newobject', 'operands': [_readU30]},
+    0x1E: {'name': 'nextname', 'operands': []},
+    0x23: {'name': 'nextvalue', 'operands': []},
+    0x02: {'name': 'nop', 'operands': []},
+    0x96: {'name': 'not', 'operands': []},
+    0x29: {'name': 'pop', 'operands': []},
+    0x1D: {'name': 'popscope', 'operands': []},
+    0x24: {'name': 'pushbyte', 'operands': [_readU8]},
+    0x2F: {'name': 'pushdouble',
+           'operands': [_readU30],
+           'handler': '_operands_double'},
+    0x27: {'name': 'pushfalse', 'operands': []},
+    0x2D: {'name': 'pushint',
+           'operands': [_readU30],
+           'handler': '_operands_int'},
+    0x31: {'name': 'pushnamespace',
+           'operands': [_readU30],
+           'handler': '_operands_namespace'},
+    0x28: {'name': 'pushnan', 'operands': []},
+    0x20: {'name': 'pushnull', 'operands': []},
+    0x30: {'name': 'pushscope', 'operands': []},
+    0x25: {'name': 'pushshort', 'operands': [_readU30]},
+    0x2C: {'name': 'pushstring',
+           'operands': [_readU30],
+           'handler': '_operands_string'},
+    0x26: {'name': 'pushtrue', 'operands': []},
+    0x2E: {'name': 'pushuint',
+           'operands': [_readU30],
+           'handler': '_operands_uint'},
+    0x21: {'name': 'pushundefined', 'operands': []},
+    0x1C: {'name': 'pushwith', 'operands': []},
+    0x48: {'name': 'returnvalue', 'operands': []},
+    0x47: {'name': 'returnvoid', 'operands': []},
+    0xA6: {'name': 'rshift', 'operands': []},
+    0x63: {'name': 'setlocal', 'operands': [_readU30]},
+    0xD4: {'name': 'setlocal_0', 'operands': []},
+    0xD5: {'name': 'setlocal_1', 'operands': []},
+    0xD6: {'name': 'setlocal_2', 'operands': []},
+    0xD7: {'name': 'setlocal_3', 'operands': []},
+    0x6F: {'name': 'setglobalslot', 'operands': [_readU30]},
+    0x61: {'name': 'setproperty',
+           'operands': [_readU30],
+           'handler': '_operands_multiname'},
+    0x6D: {'name': 'setslot', 'operands': [_readU30]},
+    0x05: {'name': 'setsuper',
+           'operands': [_readU30],
+           'handler': '_operands_multiname'},
+    0xAC: {'name': 'strictequals', 'operands': []},
+    0xA1: {'name': 'subtract', 'operands': []},
+    0xC6: {'name': 'subtract_i', 'operands': []},
+    0x2B: {'name': 'swap', 'operands': []},
+    0x03: {'name': 'throw', 'operands': []},
+    0x95: {'name': 'typeof', 'operands': []},
+    0xA7: {'name': 'urshift', 'operands': []}}
+
+# The table every MethodBody decodes with, indexed by opcode byte. Slots
+# are (name, operand readers, handler name) or None for invalid opcodes.
+# Handlers are MethodBody methods resolving the operands.
+_OPCODE_TABLE = [None] * 256
+for (opcode, op_details) in _OPCODES.iteritems():
+    _OPCODE_TABLE[opcode] = (op_details['name'],
+                             tuple(op_details['operands']),
+                             op_details.get('handler'))
+del opcode, op_details
+
+# How to step over the operands of each opcode without decoding them, for
+# MethodBody.opcodes(). A positive step skips that many bytes, 0 skips a
+# variable length U30.
+_OPERAND_STEPS = {_readU8: 1, _readS24: 3, _readU30: 0}
+_OPERAND_SKIP = [None] * 256
+for (opcode, op_details) in enumerate(_OPCODE_TABLE):
+    if op_details is not None:
+        _OPERAND_SKIP[opcode] = tuple(_OPERAND_STEPS[reader]
+                                      for reader in op_details[1])
+del opcode, op_details
+
 class MethodBody(ABCdCommon):
+    __slots__ = ('_method', '_max_stack', '_local_count', '_init_scope_depth',
+                 '_max_scope_depth', '_code', '_exceptions', '_traits',
+                 '_parser', '_offset', '_code_length', '_opcode_hash',
+                 '_instruction_offsets', '_cfg', '_code_digest')
+
     def __init__(self,
                  method,
                  max_stack,
@@ -335,7 +1025,9 @@ class MethodBody(ABCdCommon):
                  code,
                  exceptions,
                  traits,
-                 parser):
+                 parser,
+                 offset=None,
+                 code_length=None):
         self._method = method
         self._max_stack = max_stack
         self._local_count = local_count
@@ -345,258 +1037,15 @@ class MethodBody(ABCdCommon):
         self._exceptions = exceptions
         self._traits = traits
         self._parser = parser
-
-        # The "ActionScript Virtual Machine 2 (AVM2) Overview" documentation
-        # published by Adobe was last updated in 2007 and does not contain
-        # all instructions. Looks like https://github.com/adobe-flash/avmplus
-        # has a lot of the missing ones.
-        self._OPCODES = {
-            # These are the ones not mentioned in official documentation.
-            # These are prefixed with 'OP_' to visually stand out.
-            0x01: {'name': 'OP_bkpt', 'operands': []},
-            0x22: {'name': 'OP_pushconstant', 'operands': []},
-            0x35: {'name': 'OP_li8', 'operands': []},
-            0x36: {'name': 'OP_li16', 'operands': []},
-            0x37: {'name': 'OP_li32', 'operands': []},
-            0x38: {'name': 'OP_lf32', 'operands': []},
-            0x39: {'name': 'OP_lf64', 'operands': []},
-            0x3A: {'name': 'OP_si8', 'operands': []},
-            0x3B: {'name': 'OP_si16', 'operands': []},
-            0x3C: {'name': 'OP_si32', 'operands': []},
-            0x3D: {'name': 'OP_sf32', 'operands': []},
-            0x3E: {'name': 'OP_sf64', 'operands': []},
-            0x4B: {'name': 'OP_callsuperid', 'operands': []},
-            0x4D: {'name': 'OP_callinterface', 'operands': []},
-            0x50: {'name': 'OP_sxi1', 'operands': []},
-            0x51: {'name': 'OP_sxi8', 'operands': []},
-            0x52: {'name': 'OP_sxi16', 'operands': []},
-            0x53: {'name': 'OP_applytype', 'operands': [self._readU30]},
-            0x5F: {'name': 'OP_finddef', 'operands': [self._readU30]},
-            0x67: {'name': 'OP_getouterscope', 'operands': []},
-            0x6B: {'name': 'OP_deletepropertylate', 'operands': []},
-            0x81: {'name': 'OP_coerce_b', 'operands': []},
-            0x83: {'name': 'OP_coerce_i', 'operands': []},
-            0x84: {'name': 'OP_coerce_d', 'operands': []},
-            0x84: {'name': 'OP_coerce_d', 'operands': []},
-            0x88: {'name': 'OP_coerce_u', 'operands': []},
-            0x89: {'name': 'OP_coerce_o', 'operands': []},
-            0x9A: {'name': 'OP_concat', 'operands': []},
-            0x9B: {'name': 'OP_add_d', 'operands': []},
-            0xF2: {'name': 'OP_bkptline', 'operands': [self._readU30]},
-            0xF3: {'name': 'OP_timestamp', 'operands': []},
-            # And now with the documented ones...
-            0xA0: {'name': 'add', 'operands': []},
-            0xC5: {'name': 'add_i', 'operands': []},
-            0x86: {'name': 'astype', 'operands': []},
-            0x87: {'name': 'astypelate', 'operands': []},
-            0xA8: {'name': 'bitand', 'operands': []},
-            0x97: {'name': 'bitnot', 'operands': []},
-            0xA9: {'name': 'bitor', 'operands': []},
-            0xAA: {'name': 'bitxor', 'operands': []},
-            0x41: {'name': 'call', 'operands': [self._readU30]},
-            0x43: {'name': 'callmethod', 'operands': [self._readU30,
-                                                      self._readU30]},
-            0x46: {'name': 'callproperty',
-                   'operands': [self._readU30, self._readU30],
-                   'handler': self._operands_multiname_and_arg},
-            0x4C: {'name': 'callproplex',
-                   'operands': [self._readU30, self._readU30],
-                   'handler': self._operands_multiname_and_arg},
-            0x4F: {'name': 'callpropvoid',
-                   'operands': [self._readU30, self._readU30],
-                   'handler': self._operands_multiname_and_arg},
-            0x44: {'name': 'callstatic',
-                   'operands': [self._readU30, self._readU30],
-                   'handler': self._operands_method_info_and_arg},
-            0x45: {'name': 'callsuper',
-                   'operands': [self._readU30, self._readU30],
-                   'handler': self._operands_multiname_and_arg},
-            0x4E: {'name': 'callsupervoid',
-                   'operands': [self._readU30, self._readU30],
-                   'handler': self._operands_multiname_and_arg},
-            0x78: {'name': 'checkfilter', 'operands': []},
-            0x80: {'name': 'coerce',
-                   'operands': [self._readU30],
-                   'handler': self._operands_multiname},
-            0x82: {'name': 'coerce_a', 'operands': []},
-            0x85: {'name': 'coerce_s', 'operands': []},
-            0x42: {'name': 'construct', 'operands': [self._readU30]},
-            0x4A: {'name': 'constructprop',
-                   'operands': [self._readU30, self._readU30],
-                   'handler': self._operands_multiname_and_arg},
-            0x49: {'name': 'constructsuper', 'operands': [self._readU30]},
-            0x76: {'name': 'convert_b', 'operands': []},
-            0x73: {'name': 'convert_i', 'operands': []},
-            0x75: {'name': 'convert_d', 'operands': []},
-            0x77: {'name': 'convert_o', 'operands': []},
-            0x74: {'name': 'convert_u', 'operands': []},
-            0x70: {'name': 'convert_s', 'operands': []},
-            # XXX: Add a handler for this.
-            0xEF: {'name': 'debug', 'operands': [self._readU8,
-                                                 self._readU30,
-                                                 self._readU8,
-                                                 self._readU30]},
-            0xF1: {'name': 'debugfile',
-                   'operands': [self._readU30],
-                   'handler': self._operands_string},
-            0xF0: {'name': 'debugline', 'operands': [self._readU30]},
-            0x94: {'name': 'declocal', 'operands': [self._readU30]},
-            0xC3: {'name': 'declocal_i', 'operands': [self._readU30]},
-            0x93: {'name': 'decrement', 'operands': []},
-            0xC1: {'name': 'decrement_i', 'operands': []},
-            0x6A: {'name': 'deleteproperty',
-                   'operands': [self._readU30],
-                   'handler': self._operands_multiname},
-            0xA3: {'name': 'divide', 'operands': []},
-            0x2A: {'name': 'dup', 'operands': []},
-            0x06: {'name': 'dxns',
-                   'operands': [self._readU30],
-                   'handler': self._operands_string},
-            0x07: {'name': 'dxnslate', 'operands': []},
-            0xAB: {'name': 'equals', 'operands': []},
-            0x72: {'name': 'esc_xattr', 'operands': []},
-            0x71: {'name': 'esc_xelem', 'operands': []},
-            0x5E: {'name': 'findproperty',
-                   'operands': [self._readU30],
-                   'handler': self._operands_multiname},
-            0x5D: {'name': 'findpropstrict',
-                   'operands': [self._readU30],
-                   'handler': self._operands_multiname},
-            0x59: {'name': 'getdescendants',
-                   'operands': [self._readU30],
-                   'handler': self._operands_multiname},
-            0x64: {'name': 'getglobalscope', 'operands': []},
-            0x6E: {'name': 'getglobalslot', 'operands': [self._readU30]},
-            0x60: {'name': 'getlex',
-                   'operands': [self._readU30],
-                   'handler': self._operands_multiname},
-            0x62: {'name': 'getlocal', 'operands': [self._readU30]},
-            0xD0: {'name': 'getlocal_0', 'operands': []},
-            0xD1: {'name': 'getlocal_1', 'operands': []},
-            0xD2: {'name': 'getlocal_2', 'operands': []},
-            0xD3: {'name': 'getlocal_3', 'operands': []},
-            0x66: {'name': 'getproperty',
-                   'operands': [self._readU30],
-                   'handler': self._operands_multiname},
-            0x65: {'name': 'getscopeobject', 'operands': [self._readU8]},
-            0x6C: {'name': 'getslot', 'operands': [self._readU30]},
-            0x04: {'name': 'getsuper',
-                   'operands': [self._readU30],
-                   'handler': self._operands_multiname},
-            # Docs list 0xAF twice... :(
-            # 0xAF is greaterthan, 0xB0 is greaterequals.
-            0xAF: {'name': 'greaterthan', 'operands': []},
-            0xB0: {'name': 'greaterequals', 'operands': []},
-            0x1F: {'name': 'hasnext', 'operands': []},
-            0x32: {'name': 'hasnext2', 'operands': [self._readU30,
-                                                    self._readU30]},
-            0x13: {'name': 'ifeq', 'operands': [self._readS24]},
-            0x12: {'name': 'iffalse', 'operands': [self._readS24]},
-            0x18: {'name': 'ifge', 'operands': [self._readS24]},
-            0x17: {'name': 'ifgt', 'operands': [self._readS24]},
-            0x16: {'name': 'ifle', 'operands': [self._readS24]},
-            0x15: {'name': 'iflt', 'operands': [self._readS24]},
-            0x0F: {'name': 'ifnge', 'operands': [self._readS24]},
-            0x0E: {'name': 'ifngt', 'operands': [self._readS24]},
-            0x0D: {'name': 'ifnle', 'operands': [self._readS24]},
-            0x0C: {'name': 'ifnlt', 'operands': [self._readS24]},
-            0x14: {'name': 'ifne', 'operands': [self._readS24]},
-            0x19: {'name': 'ifstricteq', 'operands': [self._readS24]},
-            0x1A: {'name': 'ifstrictne', 'operands': [self._readS24]},
-            0x11: {'name': 'iftrue', 'operands': [self._readS24]},
-            0xB4: {'name': 'in', 'operands': []},
-            0x92: {'name': 'inclocal', 'operands': [self._readU30]},
-            0xC2: {'name': 'inclocal_i', 'operands': [self._readU30]},
-            0x91: {'name': 'increment', 'operands': []},
-            0xC0: {'name': 'increment_i', 'operands': []},
-            0x68: {'name': 'initproperty',
-                   'operands': [self._readU30],
-                   'handler': self._operands_multiname},
-            0xB1: {'name': 'instanceof', 'operands': []},
-            0xB2: {'name': 'istype',
-                   'operands': [self._readU30],
-                   'handler': self._operands_multiname},
-            0xB3: {'name': 'istypelate', 'operands': []},
-            0x10: {'name': 'jump', 'operands': [self._readS24]},
-            0x08: {'name': 'kill', 'operands': [self._readU30]},
-            0x09: {'name': 'label', 'operands': []},
-            0xAE: {'name': 'lessequals', 'operands': []},
-            0xAD: {'name': 'lessthan', 'operands': []},
-            0x34: {'name': 'pushdnan', 'operands': []},
-            # Variable length operands! :(
-            # default_offset, case_count, case_offsets...
-            0x1B: {'name': 'lookupswitch', 'operands': [self._readS24,
-                                                        self._readU30]},
-            0xA5: {'name': 'lshift', 'operands': []},
-            0xA4: {'name': 'modulo', 'operands': []},
-            0xA2: {'name': 'multiply', 'operands': []},
-            0xC7: {'name': 'multiply_i', 'operands': []},
-            0x90: {'name': 'negate', 'operands': []},
-            0xC4: {'name': 'negate_i', 'operands': []},
-            0x57: {'name': 'newactivation', 'operands': []},
-            0x56: {'name': 'newarray', 'operands': [self._readU30]},
-            0x5A: {'name': 'newcatch',
-                   'operands': [self._readU30],
-                   'handler': self._operands_exception},
-            # XXX: Handle operands for newclass...
-            0x58: {'name': 'newclass', 'operands': [self._readU30]},
-            0x40: {'name': 'newfunction',
-                   'operands': [self._readU30],
-                   'handler': self._operands_method_info},
-            0x55: {'name': 'newobject', 'operands': [self._readU30]},
-            0x1E: {'name': 'nextname', 'operands': []},
-            0x23: {'name': 'nextvalue', 'operands': []},
-            0x02: {'name': 'nop', 'operands': []},
-            0x96: {'name': 'not', 'operands': []},
-            0x29: {'name': 'pop', 'operands': []},
-            0x1D: {'name': 'popscope', 'operands': []},
-            0x24: {'name': 'pushbyte', 'operands': [self._readU8]},
-            0x2F: {'name': 'pushdouble',
-                   'operands': [self._readU30],
-                   'handler': self._operands_double},
-            0x27: {'name': 'pushfalse', 'operands': []},
-            0x2D: {'name': 'pushint',
-                   'operands': [self._readU30],
-                   'handler': self._operands_int},
-            0x31: {'name': 'pushnamespace',
-                   'operands': [self._readU30],
-                   'handler': self._operands_namespace},
-            0x28: {'name': 'pushnan', 'operands': []},
-            0x20: {'name': 'pushnull', 'operands': []},
-            0x30: {'name': 'pushscope', 'operands': []},
-            0x25: {'name': 'pushshort', 'operands': [self._readU30]},
-            0x2C: {'name': 'pushstring',
-                   'operands': [self._readU30],
-                   'handler': self._operands_string},
-            0x26: {'name': 'pushtrue', 'operands': []},
-            0x2E: {'name': 'pushuint',
-                   'operands': [self._readU30],
-                   'handler': self._operands_uint},
-            0x21: {'name': 'pushundefined', 'operands': []},
-            0x1C: {'name': 'pushwith', 'operands': []},
-            0x48: {'name': 'returnvalue', 'operands': []},
-            0x47: {'name': 'returnvoid', 'operands': []},
-            0xA6: {'name': 'rshift', 'operands': []},
-            0x63: {'name': 'setlocal', 'operands': [self._readU30]},
-            0xD4: {'name': 'setlocal_0', 'operands': []},
-            0xD5: {'name': 'setlocal_1', 'operands': []},
-            0xD6: {'name': 'setlocal_2', 'operands': []},
-            0xD7: {'name': 'setlocal_3', 'operands': []},
-            0x6F: {'name': 'setglobalslot', 'operands': [self._readU30]},
-            0x61: {'name': 'setproperty',
-                   'operands': [self._readU30],
-                   'handler': self._operands_multiname},
-            0x6D: {'name': 'setslot', 'operands': [self._readU30]},
-            0x05: {'name': 'setsuper',
-                   'operands': [self._readU30],
-                   'handler': self._operands_multiname},
-            0xAC: {'name': 'strictequals', 'operands': []},
-            0xA1: {'name': 'subtract', 'operands': []},
-            0xC6: {'name': 'subtract_i', 'operands': []},
-            0x2B: {'name': 'swap', 'operands': []},
-            0x03: {'name': 'throw', 'operands': []},
-            0x95: {'name': 'typeof', 'operands': []},
-            0xA7: {'name': 'urshift', 'operands': []}}
+        # When the parser skipped over this body code, exceptions and traits
+        # are None and are parsed from offset (the start of the code) the
+        # first time they are accessed.
+        self._offset = offset
+        self._code_length = code_length
+        self._opcode_hash = None
+        self._instruction_offsets = None
+        self._cfg = None
+        self._code_digest = None
 
     @property
     def method(self):
@@ -625,68 +1074,338 @@ class MethodBody(ABCdCommon):
 
     @property
     def code(self):
-        """AVM2 instructions."""
-        return self._code
+        """AVM2 instructions, as a view into the original ABC data."""
+        if self._code is not None:
+            return self._code
+        code = self._parser._view(self._offset, self._code_length)
+        # Views are free to keep, but when parsing from a file this is a
+        # copy and keeping it would defeat the point.
+        if self._parser._stream is None:
+            self._code = code
+        return code
 
     @property
     def exceptions(self):
         """List of Exception objects."""
+        if self._exceptions is None:
+            self._load_tail()
         return self._exceptions
 
     @property
     def traits(self):
       """List of traits."""
+      if self._traits is None:
+          self._load_tail()
       return self._traits
 
-    def _get_operands(self, operands):
-        return [func() for func in operands]
+    def __reduce__(self):
+        # Code is a view into the data, it is found again from its offset.
+        return (MethodBody, (self._method,
+                             self._max_stack,
+                             self._local_count,
+                             self._init_scope_depth,
+                             self._max_scope_depth,
+                             None,
+                             self._exceptions,
+                             self._traits,
+                             self._parser,
+                             self._offset,
+                             self._code_length))
+
+    def _load_tail(self):
+        (self._exceptions, self._traits) = self._parser._read_at(
+            self._offset + self._code_length,
+            self._parser._readMethodBodyTail)
+
+    @property
+    def _max_entries(self):
+        return self._parser._max_entries
+
+    def _cursor(self, p=0):
+        # Code is decoded through a cursor of its own, so walks over the
+        # same body can be interleaved.
+        cursor = Cursor(self.code, p)
+        cursor._max_entries = self._max_entries
+        return cursor
+
+    def _checkInstructions(self, count, offset):
+        limit = self._parser._limits.max_instructions
+        if limit is not None and count > limit:
+            raise ABCdParseError("Body exceeds max_instructions", offset)
 
     def strip_operands(self):
         """Strip operands from AVM2 code, returning only opcodes."""
-        self._data = self.code
-        self.p = 0
-        stripped = ''
-        while self.p < len(self.code):
-            opcode = self._readU8()
-            stripped += chr(opcode)
-            try:
-                op_details = self._OPCODES[opcode]
-            except KeyError:
-                raise ABCdBadOpcode(opcode)
-            # Do nothing with operands unless lookupswitch
-            operands = self._get_operands(op_details['operands'])
-            if op_details['name'] == 'lookupswitch':
-                # Second operand is case_count, there are case_count + 1
-                # remaining S24 operands.
-                for i in xrange(0, operands[1] + 1):
-                    self._readS24()
-        return stripped
+        return str(self.opcodes())
+
+    def opcodes(self):
+        """Opcodes of the AVM2 code without their operands, as a bytearray.
+
+        Operands are stepped over without being decoded, apart from the
+        lookupswitch case count.
+        """
+        return self._scan()
+
+    def instruction_offsets(self):
+        """Sorted array of the offset of each instruction, computed once."""
+        if self._instruction_offsets is None:
+            offsets = array('i')
+            self._scan(offsets)
+            self._instruction_offsets = offsets
+        return self._instruction_offsets
+
+    def instruction_index(self, offset):
+        """Index of the instruction covering offset in the code.
+
+        Raises IndexError if offset is outside the code.
+        """
+        offsets = self.instruction_offsets()
+        if offset < 0 or offset >= len(self.code):
+            raise IndexError("Offset outside code: %d" % offset)
+        return bisect_right(offsets, offset) - 1
+
+    def instruction_at(self, offset):
+        """OpCode of the instruction covering offset in the code.
+
+        Only that instruction is decoded. Compare the offset of the result
+        to tell whether offset falls in the middle of it.
+        """
+        start = self.instruction_offsets()[self.instruction_index(offset)]
+        cursor = self._cursor(start)
+        (start, opcode, op_details, operands) = self._decodeNext(cursor)
+        return self._opcode(opcode, operands, start, cursor.p - start)
+
+    def cfg(self):
+        """ControlFlowGraph of the code, computed once.
+
+        Blocks start at the beginning of the code, at branch targets, after
+        branches and instructions which do not fall through, and at the
+        bounds and handlers of exceptions. Targets which do not fall on an
+        instruction, as in some obfuscated code, are left out.
+        """
+        if self._cfg is not None:
+            return self._cfg
+        offsets = self.instruction_offsets()
+        end = len(self.code)
+
+        def valid(offset):
+            # Only offsets starting an instruction begin a block.
+            if offset < 0 or offset >= end:
+                return False
+            return offsets[bisect_right(offsets, offset) - 1] == offset
+
+        instructions = []
+        leaders = set()
+        if end:
+            leaders.add(0)
+        for instr in self.disassemble():
+            targets = [t for t in instr.targets if valid(t)]
+            instructions.append((instr.offset + instr.size, instr.opcode,
+                                 targets))
+            leaders.update(targets)
+            if instr.opcode in _BRANCHES or instr.opcode in _NO_FALLTHROUGH:
+                leaders.add(instr.offset + instr.size)
+        handlers = []
+        for exc in self.exceptions:
+            for offset in (exc.from_, exc.to, exc.target):
+                if valid(offset):
+                    leaders.add(offset)
+            if valid(exc.target):
+                handlers.append((exc.from_, exc.to, exc.target))
+        leaders.discard(end)
+
+        start = array('i', sorted(leaders))
+        edge_start = array('i', [0])
+        successor = array('i')
+        block = 0
+        for (next_, opcode, targets) in instructions:
+            if block + 1 < len(start):
+                block_end = start[block + 1]
+            else:
+                block_end = end
+            if next_ < block_end:
+                continue
+            # Last instruction of the block.
+            succ = [bisect_right(start, t) - 1 for t in targets]
+            if opcode not in _NO_FALLTHROUGH and block + 1 < len(start):
+                succ.append(block + 1)
+            for (from_, to, target) in handlers:
+                if from_ <= start[block] < to:
+                    succ.append(bisect_right(start, target) - 1)
+            seen = set()
+            for s in succ:
+                if s not in seen:
+                    seen.add(s)
+                    successor.append(s)
+            edge_start.append(len(successor))
+            block += 1
+        self._cfg = ControlFlowGraph(start, edge_start, successor)
+        return self._cfg
+
+    def _scan(self, offsets=None):
+        # Step over the code as opcodes() describes, appending the offset
+        # of each instruction to offsets if given.
+        code = bytearray(self.code)
+        end = len(code)
+        limit = self._parser._limits.max_instructions
+        result = bytearray()
+        append = result.append
+        skip = _OPERAND_SKIP
+        i = 0
+        try:
+            while i < end:
+                opcode = code[i]
+                steps = skip[opcode]
+                if steps is None:
+                    raise ABCdBadOpcode(opcode)
+                append(opcode)
+                if offsets is not None:
+                    offsets.append(i)
+                if limit is not None and len(result) > limit:
+                    raise ABCdParseError("Body exceeds max_instructions", i)
+                i += 1
+                if opcode == 0x1B: # lookupswitch
+                    # default_offset, case_count, then case_count + 1
+                    # more offsets.
+                    cursor = Cursor(code, i + 3)
+                    cursor._max_entries = self._max_entries
+                    case_count = cursor._readU30()
+                    cursor._checkCount(case_count + 1, 3, cursor.p)
+                    i = cursor.p + (case_count + 1) * 3
+                    continue
+                for step in steps:
+                    if step:
+                        i += step
+                    else:
+                        last = i + 4
+                        while i < last and code[i] & 0x80:
+                            i += 1
+                        i += 1
+        except IndexError:
+            raise ABCdParseError("Code truncated", i)
+        # The last operand must not run past the end of the code.
+        if i > end:
+            raise ABCdParseError("Code truncated", end)
+        return result
+
+    def opcode_hash(self):
+        """MD5 hex digest of opcodes(), computed once."""
+        if self._opcode_hash is None:
+            self._opcode_hash = self._cached('opcode_hash')
+        if self._opcode_hash is None:
+            self._opcode_hash = hashlib.md5(self.opcodes()).hexdigest()
+            self._store('opcode_hash', self._opcode_hash)
+        return self._opcode_hash
+
+    def code_digest(self):
+        """SHA-256 hex digest of the code, computed once.
+
+        This is what CodeCache entries are keyed by. Code comes from hostile
+        files, so a digest without known collisions is used.
+        """
+        if self._code_digest is None:
+            self._code_digest = hashlib.sha256(self.code).hexdigest()
+        return self._code_digest
+
+    def _cached(self, kind):
+        # Look kind up in the parser's CodeCache, if it has one.
+        code_cache = self._parser._code_cache
+        if code_cache is None:
+            return None
+        return code_cache.get(self.code_digest(), kind)
+
+    def _store(self, kind, value):
+        code_cache = self._parser._code_cache
+        if code_cache is not None:
+            code_cache.put(self.code_digest(), kind, value)
+
+    def _cached_instructions(self):
+        columns = self._cached('instructions')
+        if columns is None:
+            return None
+        # Limits still apply to code decoded for another body.
+        self._checkInstructions(len(columns[1]), 0)
+        return InstructionTable(self, columns)
 
     def disassemble(self):
         """Generator for disassembly information, yielding OpCode."""
-        self._data = self.code
-        self.p = 0
-        while self.p < len(self.code):
-            opcode = self._readU8()
+        table = self._cached_instructions()
+        if table is not None:
+            for instr in table:
+                yield instr
+            return
+        if self._parser._code_cache is not None:
+            table = InstructionTable(self)
+        cursor = self._cursor()
+        for (offset, opcode, op_details, operands) in self._decode(cursor):
+            if table is not None:
+                table.append(offset, opcode, operands)
+            yield self._opcode(opcode, operands, offset, cursor.p - offset)
+        if table is not None:
+            self._store('instructions', table.columns)
+
+    def decode_columnar(self):
+        """Decode all instructions into an InstructionTable.
+
+        No object is kept per instruction, OpCode objects are only built
+        when the table is indexed. With a CodeCache the arrays may be
+        shared with other bodies having the same code.
+        """
+        table = self._cached_instructions()
+        if table is not None:
+            return table
+        table = InstructionTable(self)
+        for (offset, opcode, op_details, operands) in self._decode():
+            table.append(offset, opcode, operands)
+        self._store('instructions', table.columns)
+        return table
+
+    def _opcode(self, opcode, operands, offset=None, size=None):
+        (name, readers, handler) = _OPCODE_TABLE[opcode]
+        return OpCode(opcode, operands, name, self, handler, offset, size)
+
+    def references(self):
+        """Generator for operands referring to constants or methods.
+
+        Yields (kind, index, offset, opcode) with kind one of
+        ABCParser.XREF_KINDS, index the entry referred to and offset the
+        offset of the instruction in the code.
+        """
+        for (offset, opcode, op_details, operands) in self._decode():
             try:
-                op_details = self._OPCODES[opcode]
+                (kind, count) = _XREF_HANDLERS[op_details[2]]
             except KeyError:
-                raise ABCdBadOpcode(opcode)
-            operands = self._get_operands(op_details['operands'])
-            if op_details['name'] == 'lookupswitch':
-                # Second operand is case_count, there are case_count + 1
-                # remaining S24 operands.
-                for i in xrange(0, operands[1] + 1):
-                    operands.append(self._readS24())
-
-            # Resolve any operands using handler...
-            try:
-                operands = op_details['handler'](operands)
-            except:
-                # No handler, or problem in handler...
-                pass
-
-            yield OpCode(opcode, operands, op_details['name'])
+                continue
+            for index in operands[:count]:
+                yield (kind, index, offset, opcode)
+
+    def _decode(self, cursor=None):
+        # Generator yielding (offset, opcode, op_details, operands) for each
+        # instruction, with the operands as they are in the code. cursor is
+        # left after the instruction last yielded.
+        if cursor is None:
+            cursor = self._cursor()
+        end = len(cursor._data)
+        count = 0
+        while cursor.p < end:
+            count += 1
+            self._checkInstructions(count, cursor.p)
+            yield self._decodeNext(cursor)
+
+    def _decodeNext(self, cursor):
+        # Decode the instruction at cursor.p, leaving cursor.p after it.
+        offset = cursor.p
+        opcode = cursor._readU8()
+        op_details = _OPCODE_TABLE[opcode]
+        if op_details is None:
+            raise ABCdBadOpcode(opcode)
+        operands = [func(cursor) for func in op_details[1]]
+        if opcode == 0x1B: # lookupswitch
+            # Second operand is case_count, there are case_count + 1
+            # remaining S24 operands.
+            cursor._checkCount(operands[1] + 1, 3, cursor.p)
+            for i in xrange(0, operands[1] + 1):
+                operands.append(cursor._readS24())
+        return (offset, opcode, op_details, operands)
 
     def _operands_string(self, operands):
         return [self._parser.strings[operand] for operand in operands]
@@ -706,17 +1425,17 @@ class MethodBody(ABCdCommon):
     def _operands_namespace(self, operands):
         result = []
         for operand in operands:
-            ns = self.parser.namespaces[operand]
-            name = ns.name
+            ns = self._parser.namespaces[operand]
+            name = self._parser.strings[ns.name]
             kind = self._parser.CONST_KIND[ns.kind]
             result.append("%s: %s" % (kind, name))
         return result
 
     def _operands_method_info(self, operands):
-        return [str(self._parser.methods[operand]) for operand in operands]
+        return [unicode(self._parser.methods[operand]) for operand in operands]
 
     def _operands_exception(self, operands):
-        return [str(self.exceptions[operand]) for operand in operands]
+        return [unicode(self.exceptions[operand]) for operand in operands]
 
     def _operands_multiname_and_arg(self, operands):
         # Make a copy of operands, as to not alter the mutable list.
@@ -729,13 +1448,12 @@ class MethodBody(ABCdCommon):
         # Make a copy of operands, as to not alter the mutable list.
         result = list(operands)
         # Element 0 is index into methods, Element 1 is arg_count.
-        try:
-            result[0] = str(self._parser.methods[operands[0]])
-        except:
-            pass
+        result[0] = unicode(self._parser.methods[operands[0]])
         return result
 
 class Trait(object):
+    __slots__ = ('_name', '_kind', '_data', '_metadata')
+
     def __init__(self, name, kind, data, metadata):
         if name == 0:
             raise ABCdBadValue("Invalid trait name", name)
@@ -761,10 +1479,12 @@ class Trait(object):
 
     @property
     def metadata(self):
-        """List of indices into metadata array."""
+        """Tuple of indices into metadata array."""
         return self._metadata
 
 class Slot_Trait(object):
+    __slots__ = ('_slot_id', '_type_name', '_vindex', '_vkind')
+
     def __init__(self, slot_id, type_name, vindex, vkind):
         self._slot_id = slot_id
         self._type_name = type_name
@@ -792,6 +1512,8 @@ class Slot_Trait(object):
         return self._vkind
 
 class Class_Trait(object):
+    __slots__ = ('_slot_id', '_classi')
+
     def __init__(self, slot_id, classi):
         self._slot_id = slot_id
         self._classi = classi
@@ -807,6 +1529,8 @@ class Class_Trait(object):
         return self._classi
 
 class Function_Trait(object):
+    __slots__ = ('_slot_id', '_function')
+
     def __init__(self, slot_id, function):
         self._slot_id = slot_id
         self._function = function
@@ -822,6 +1546,8 @@ class Function_Trait(object):
         return self._function
 
 class Method_Trait(object):
+    __slots__ = ('_disp_id', '_method')
+
     def __init__(self, disp_id, method):
         self._disp_id = disp_id
         self._method = method
@@ -837,6 +1563,9 @@ class Method_Trait(object):
         return self._method
 
 class ASException(object):
+    __slots__ = ('_from', '_to', '_target', '_exc_type', '_var_name',
+                 '_parser')
+
     def __init__(self, from_, to, target, exc_type, var_name, parser):
         self._from = from_
         self._to = to
@@ -855,6 +1584,11 @@ class ASException(object):
         """Ending position after which this exception is disabled."""
         return self._to
 
+    @property
+    def target(self):
+        """Position of the exception handler."""
+        return self._target
+
     @property
     def exc_type(self):
         """Multiname of the exception."""
@@ -868,13 +1602,16 @@ class ASException(object):
     # AVM2 docs say exc_type and var_name are indexes into strings array, which
     # is wrong. They are actually indexes into the multiname array.
     def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def __unicode__(self):
         if self.exc_type == 0:
-            etype = "*"
+            etype = u"*"
         else:
             etype = self._parser.resolve_multiname(self.exc_type)
 
         if self.var_name != 0:
-            return "%s as %s" % (etype,
-                                 self._parser.resolve_multiname(self.var_name))
+            return u"%s as %s" % (etype,
+                                  self._parser.resolve_multiname(self.var_name))
         else:
-            return etype
+            return unicode(etype)
@@ -0,0 +1,93 @@
+# Copyright (c) 2015 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+
+import gc
+import time
+
+class ParseObserver(object):
+    """Hooks called by ABCParser.parse() around each section it parses.
+
+    name is one of the section names in ABCParser.sections, or 'cache'
+    for a cache lookup. Subclasses override what they need, the parser is
+    passed so they can look at its position and pools.
+    """
+    def section_start(self, parser, name):
+        pass
+
+    def section_end(self, parser, name):
+        pass
+
+class ParseStats(ParseObserver):
+    """Observer recording wall time, bytes, entries and objects per section.
+
+    Objects are counted as the change in objects tracked by the garbage
+    collector, which is what parsed records are. Counting them walks the
+    whole heap, pass count_objects=False to skip it.
+    """
+    # Parser properties counted as entries.
+    POOLS = ('ints', 'uints', 'doubles', 'strings', 'namespaces',
+             'namespacesets', 'multinames', 'methods', 'metadata',
+             'instances', 'classes', 'scripts', 'method_bodies')
+
+    def __init__(self, count_objects=True):
+        self._count_objects = count_objects
+        self._sections = []
+        self._start = None
+
+    @property
+    def sections(self):
+        """List of dictionaries, one per section in the order parsed."""
+        return self._sections
+
+    def _counts(self, parser):
+        return dict((pool, len(getattr(parser, pool))) for pool in self.POOLS)
+
+    def _objects(self):
+        if not self._count_objects:
+            return None
+        return len(gc.get_objects())
+
+    def section_start(self, parser, name):
+        self._start = (parser.p,
+                       self._counts(parser),
+                       self._objects(),
+                       time.time())
+
+    def section_end(self, parser, name):
+        seconds = time.time()
+        (offset, counts, objects, start) = self._start
+        seconds -= start
+        entries = {}
+        for (pool, count) in self._counts(parser).iteritems():
+            if count != counts[pool]:
+                entries[pool] = count - counts[pool]
+        if objects is not None:
+            objects = self._objects() - objects
+        self._sections.append({'section': name,
+                               'offset': offset,
+                               'bytes': parser.p - offset,
+                               'seconds': seconds,
+                               'entries': entries,
+                               'objects': objects})
+        self._start = None
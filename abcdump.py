@@ -28,6 +28,8 @@ import hashlib
 import argparse
 
 from abcd import ABCParser
+from abcd.cache import ABCCache, CodeCache
+from abcd.observer import ParseStats
 
 from swf.movie import SWF
 
@@ -100,12 +102,20 @@ def dump_bodies(parser):
         print "\tExceptions: %s" % len(body.exceptions)
         print "\tCode length: %s" % len(body.code)
         print "\tCode MD5: %s" % hashlib.md5(body.code).hexdigest()
-        print "\tOpcodes MD5: %s" % hashlib.md5(body.strip_operands()).hexdigest()
+        print "\tOpcodes MD5: %s" % body.opcode_hash()
         print "\tDisassembly:"
         for instr in body.disassemble():
             print "\t%s (%s): %s" % (instr.name,
                                      instr.opcode,
-                                     ', '.join(str(op) for op in instr.operands))
+                                     u', '.join(unicode(op) for op in instr.operands))
+            if instr.error:
+                print "\t\tUnresolved operands: %s" % instr.error
+
+def dump_strings(parser):
+    print "---------------------------------------------------------------"
+    # Raw bytes, nothing is decoded for a triage dump.
+    for (c, string) in enumerate(parser.iter_strings(raw=True), 1):
+        print "String %s: %s" % (c, string)
 
 def dump_instances(parser):
     print "---------------------------------------------------------------"
@@ -127,10 +137,30 @@ def __main__():
     parser = argparse.ArgumentParser(description='Dump actionscript stuff.')
     parser.add_argument('-s', '--script_names', action='append',
                         metavar='script', help='script name to dump')
+    parser.add_argument('-S', '--strings', action='store_true',
+                        help='only dump the string pool')
+    parser.add_argument('-a', '--abc', action='store_true',
+                        help='files are raw ABC, read from disk as needed')
+    parser.add_argument('-c', '--cache', metavar='dir',
+                        help='keep parsed ABC in dir, reused on later runs')
+    parser.add_argument('-t', '--stats', metavar='file',
+                        help='write per section parse statistics as JSON')
     parser.add_argument('files', metavar='file', nargs='+',
                         help='file to parse')
     args = parser.parse_args()
 
+    cache = None
+    if args.cache:
+        try:
+            cache = ABCCache(args.cache)
+        except (ValueError, OSError) as e:
+            print str(e)
+            return
+    # Decoded method bodies are shared between all files, and kept in the
+    # cache directory too when there is one.
+    code_cache = CodeCache(disk=cache)
+    stats = []
+
     if not args.files:
        print "Must provide a filename..."
        return
@@ -142,26 +172,45 @@ def __main__():
         except Exception as e:
             print str(e)
             continue
-        try:
-            swiff = SWF(f)
-        except Exception as e:
-            print "pyswf failure: %s" % str(e)
-            f.close()
-            continue
-        f.close()
 
         parser = None
-        for tag in swiff.tags:
-            if tag.name in ["DoABC", "DoABC2"]:
-                parser = ABCParser.ABCParser(tag.bytes)
+        observer = ParseStats() if args.stats else None
+        if args.abc:
+            # The file stays open, it is read from as the dump goes.
+            parser = ABCParser.ABCParser(f,
+                                         cache=cache,
+                                         observer=observer,
+                                         code_cache=code_cache)
+            if not args.strings:
                 parser.parse()
+            swiff = None
+        else:
+            try:
+                swiff = SWF(f)
+            except Exception as e:
+                print "pyswf failure: %s" % str(e)
+                f.close()
+                continue
+            f.close()
+
+        for tag in (swiff.tags if swiff else []):
+            if tag.name in ["DoABC", "DoABC2"]:
+                parser = ABCParser.ABCParser(tag.bytes,
+                                             cache=cache,
+                                             observer=observer,
+                                             code_cache=code_cache)
+                # The string pool is read on its own, stopping right after it.
+                if not args.strings:
+                    parser.parse()
                 #out = open("abc.as", 'wb')
                 #out.write(tag.bytes)
                 #out.close()
                 break # XXX: There can be more than one DoABC tag...
 
         # XXX: Sometimes pyswf fails to parse things... :(
-        if parser:
+        if parser and args.strings:
+            dump_strings(parser)
+        elif parser:
             dump_scripts(parser)
             dump_classes(parser)
             dump_methods(parser)
@@ -169,6 +218,14 @@ def __main__():
             dump_instances(parser)
         else:
             print "Problem finding DoABC..."
+        f.close()
+        if observer:
+            stats.append({'file': file_, 'sections': observer.sections})
+
+    if args.stats:
+        f = open(args.stats, 'w')
+        f.write(json.dumps(stats))
+        f.close()
 
 if __name__ == '__main__':
     __main__()
@@ -30,6 +30,8 @@ import binascii
 import argparse
 
 from abcd import ABCParser
+from abcd.cache import ABCCache, CodeCache
+from abcd.observer import ParseStats
 from abcd.ABCParser import ABCdException as ABCdException
 
 from swf.movie import SWF
@@ -58,14 +60,39 @@ def hexdump(data):
                                                         asciistring))
     return result
 
+def body_hexdump(parser, body):
+    # Hexdumps only depend on the code, keep them with the decoded bodies.
+    code_cache = parser.code_cache
+    if code_cache is None:
+        return hexdump(body.code)
+    dump = code_cache.get(body.code_digest(), 'hexdump')
+    if dump is None:
+        dump = hexdump(body.code)
+        code_cache.put(body.code_digest(), 'hexdump', dump)
+    return dump
+
 def disassembly_to_dict(body):
     result = []
     for instr in body.disassemble():
         result.append({'name': instr.name,
                        'opcode': instr.opcode,
+                       'offset': instr.offset,
                        'operands': instr.operands})
+        if instr.targets:
+            result[-1]['targets'] = instr.targets
+        if instr.error:
+            result[-1]['error'] = str(instr.error)
     return result
 
+def cfg_to_dict(body):
+    try:
+        cfg = body.cfg()
+    except ABCdException as e:
+        return {'method': body.method, 'error': str(e)}
+    return {'method': body.method,
+            'blocks': len(cfg),
+            'edges': list(cfg.edges())}
+
 def create_method_node(parser,
                        body,
                        nodes,
@@ -77,13 +104,9 @@ def create_method_node(parser,
                        level):
     if body == None:
         opc_hash = "NO BODY"
-        disassembly = []
-        dump = ''
     else:
         #opc_hash = hashlib.md5(body.strip_operands()).hexdigest()
         opc_hash = hashlib.md5(body.code).hexdigest()
-        disassembly = disassembly_to_dict(body)
-        dump = hexdump(body.code)
 
     if opc_hash in bodies:
         id_ = bodies[opc_hash]
@@ -100,6 +123,13 @@ def create_method_node(parser,
         if edge not in edges:
             edges.append(edge)
     else:
+        # Only new bodies are decoded.
+        if body == None:
+            disassembly = []
+            dump = ''
+        else:
+            disassembly = disassembly_to_dict(body)
+            dump = body_hexdump(parser, body)
         id_ = len(nodes)
         bodies[opc_hash] = id_
         nodes.append({'label': label,
@@ -123,27 +153,10 @@ def add_method(parser,
                color,
                label,
                level=5):
-    # Walk all bodies looking for one that references the provided method
-    # index. If found, add a node and edge.
-    for body in parser.method_bodies:
-        if body.method != meth_index:
-            continue
-
-        create_method_node(parser,
-                           body,
-                           nodes,
-                           edges,
-                           bodies,
-                           relate_to,
-                           color,
-                           label,
-                           level)
-        # Got a body for this one, return.
-        return
-
-    # Not every method has a body. In this case, create an empty body node.
+    # Add a node and edge for the body of the provided method index. Not
+    # every method has a body, in this case an empty body node is created.
     create_method_node(parser,
-                       None,
+                       parser.method_body(meth_index),
                        nodes,
                        edges,
                        bodies,
@@ -178,6 +191,12 @@ def get_traits(parser, traits):
         results.append(t)
     return results
 
+def script_class(parser, script):
+    # Index of the first class defined by script.
+    for trait in script.traits:
+        if (trait.kind & 0x0F) == parser.TRAIT_CLASS:
+            return parser.resolve_trait(trait)['class_index']
+
 # Return a list of node indexes this file relates to...
 def dump_graph(parser,
                nodes,
@@ -200,6 +219,7 @@ def dump_graph(parser,
         #script_index = id_
         #print "  [+] Found script: %s" % sname
 
+        first_class = None
         for trait in script.traits:
             if (trait.kind & 0x0F) != parser.TRAIT_CLASS:
                 continue
@@ -245,10 +265,10 @@ def dump_graph(parser,
                 continue
 
             # Make instance node for this class and handle init and method nodes.
-            for instance in parser.instances:
-                iname = parser.resolve_multiname(instance.name)
-                if iname != cname:
-                    continue
+            instance_i = parser.class_index(cname)
+            if instance_i is not None:
+                instance = parser.instances[instance_i]
+                iname = cname
 
                 # Make a node (or use existing one) for this instance.
                 if iname in instances:
@@ -289,35 +309,30 @@ def dump_graph(parser,
                            "instance init %s" % iname,
                            level=5)
 
-                # Got one instance, move along...
-                break
-
             # Make class node for this script and handle init and method nodes.
-            for trait in script.traits:
-                if (trait.kind & 0x0F) != parser.TRAIT_CLASS:
-                    continue
-
-                class_index = parser.resolve_trait(trait)['class_index']
-                klass = parser.classes[class_index]
-
-                # Add method for class init.
-                add_method(parser,
-                           klass.cinit,
-                           nodes,
-                           edges,
-                           bodies,
-                           instance_index,
-                           'yellow',
-                           "class init %s" % cname,
-                           level=5)
-
-                add_method_nodes(parser,
-                                 klass,
-                                 class_index,
-                                 nodes,
-                                 edges,
-                                 bodies)
-                break
+            # This is the first class of the script, found once per script.
+            if first_class is None:
+                first_class = script_class(parser, script)
+            class_index = first_class
+            klass = parser.classes[class_index]
+
+            # Add method for class init.
+            add_method(parser,
+                       klass.cinit,
+                       nodes,
+                       edges,
+                       bodies,
+                       instance_index,
+                       'yellow',
+                       "class init %s" % cname,
+                       level=5)
+
+            add_method_nodes(parser,
+                             klass,
+                             class_index,
+                             nodes,
+                             edges,
+                             bodies)
     return indexes
 
 def __main__():
@@ -330,10 +345,30 @@ def __main__():
                         help='enable SWF metadata tags')
     parser.add_argument('-b', '--binaries', action='store_true',
                         help='enable SWF binary tags')
+    parser.add_argument('-c', '--cache', metavar='dir',
+                        help='keep parsed ABC in dir, reused on later runs')
+    parser.add_argument('-t', '--stats', metavar='file',
+                        help='write per section parse statistics as JSON')
+    parser.add_argument('-g', '--cfg', metavar='file',
+                        help='write basic block counts and edges of every '
+                             'method body as JSON')
     parser.add_argument('files', metavar='file', nargs='+',
                         help='file to parse')
     args = parser.parse_args()
 
+    cache = None
+    if args.cache:
+        try:
+            cache = ABCCache(args.cache)
+        except (ValueError, OSError) as e:
+            print "[!] %s" % str(e)
+            return
+    # Decoded method bodies are shared between all files, and kept in the
+    # cache directory too when there is one.
+    code_cache = CodeCache(disk=cache)
+    stats = []
+    cfgs = []
+
     if not args.files:
        print "[!] Must provide a filename..."
        return
@@ -376,12 +411,26 @@ def __main__():
             elif tag.name in ["DoABC", "DoABCDefine"]:
                 if hasattr(tag, 'abcName'):
                     print " [-] ABCName: %s" % tag.abcName
-                parser = ABCParser.ABCParser(tag.bytes)
+                observer = ParseStats() if args.stats else None
+                parser = ABCParser.ABCParser(tag.bytes,
+                                             cache=cache,
+                                             observer=observer,
+                                             code_cache=code_cache)
                 try:
                     parser.parse()
                 except ABCdException as e:
                     print "[!] Parsing error: %s" % str(e)
                     continue
+                finally:
+                    # Sections up to a parsing error are kept too.
+                    if observer:
+                        stats.append({'file': file_,
+                                      'sections': observer.sections})
+
+                if args.cfg:
+                    cfgs.append({'file': file_,
+                                 'bodies': [cfg_to_dict(body)
+                                            for body in parser.method_bodies]})
 
                 indexes += dump_graph(parser,
                                       nodes,
@@ -449,5 +498,15 @@ def __main__():
     f.write(json.dumps(edges))
     f.close()
 
+    if args.stats:
+        f = open(args.stats, 'w')
+        f.write(json.dumps(stats))
+        f.close()
+
+    if args.cfg:
+        f = open(args.cfg, 'w')
+        f.write(json.dumps(cfgs))
+        f.close()
+
 if __name__ == '__main__':
     __main__()